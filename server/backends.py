@@ -0,0 +1,58 @@
+"""
+Inference backends of the YOLO segmentation model. The PyTorch weights are exported once with export_model.py,
+then loaded through ultralytics, which runs ONNX Runtime and OpenVINO models behind the same predict() API.
+
+    pytorch   yolo11<size>-seg.pt                    (downloaded by ultralytics on first use)
+    onnx      yolo11<size>-seg[_int8].onnx
+    openvino  yolo11<size>-seg[_int8]_openvino_model/
+"""
+import os
+
+BACKENDS = ("pytorch", "onnx", "openvino")
+MODEL_SIZES = ("n", "s", "m", "l")
+
+
+def weights_name(size="l"):
+    if size not in MODEL_SIZES:
+        raise ValueError(f"dimensione del modello non valida: {size} (una tra {', '.join(MODEL_SIZES)})")
+    return f"yolo11{size}-seg.pt"
+
+
+def model_path(size="l", backend="pytorch", int8=False, directory="."):
+    """
+    Path of the model of the given size for a backend, as written by export_model.py.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"backend non valido: {backend} (uno tra {', '.join(BACKENDS)})")
+    if backend == "pytorch":
+        if int8:
+            raise ValueError("la quantizzazione INT8 è disponibile solo per i backend onnx e openvino")
+        return weights_name(size)
+    stem = os.path.splitext(weights_name(size))[0] + ("_int8" if int8 else "")
+    if backend == "onnx":
+        return os.path.join(directory, stem + ".onnx")
+    return os.path.join(directory, stem + "_openvino_model")
+
+
+def parse_spec(spec):
+    # "backend:size[:int8]", e.g. "onnx:n:int8" -> ("onnx", "n", True)
+    backend, _, rest = spec.partition(":")
+    size, _, precision = rest.partition(":")
+    if precision not in ("", "int8"):
+        raise ValueError(f"precisione non valida in {spec}: solo int8")
+    return backend, size or "l", precision == "int8"
+
+
+def load_model(size="l", backend="pytorch", int8=False, directory=".", device="cpu"):
+    """
+    Loads the model for a backend. Exported models must exist already, see export_model.py.
+    """
+    from ultralytics import YOLO
+
+    path = model_path(size, backend, int8, directory)
+    if backend == "pytorch":
+        return YOLO(path).to(device=device)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} non trovato, esportalo con: python export_model.py --size {size} "
+                                f"--backend {backend}{' --int8 --calibration <pcap>' if int8 else ''}")
+    return YOLO(path, task="segment")
@@ -0,0 +1,54 @@
+import numpy as np
+
+
+class RangeBackground:
+    """
+    Per-pixel background model of the destaggered RANGE image of a fixed sensor. Every return is classified as
+    static (consistent with the learnt background range) or foreground (closer or farther than it).
+
+    tolerance: relative range difference still considered background
+    min_tolerance_mm: lower bound of the tolerance, for the near field
+    learning_rate: how fast the background follows slow changes of the matching returns
+    relearn_frames: after this many consecutive foreground frames a pixel adopts the new range as background
+        (e.g. a parked wagon becomes part of the scene)
+    """
+
+    def __init__(self, shape, tolerance=0.03, min_tolerance_mm=150, learning_rate=0.05, relearn_frames=300):
+        self.tolerance = tolerance
+        self.min_tolerance_mm = min_tolerance_mm
+        self.learning_rate = learning_rate
+        self.relearn_frames = relearn_frames
+        self.background = np.zeros(shape, np.float32)  # 0 means no background learnt yet
+        self._mismatch = np.zeros(shape, np.uint16)  # consecutive frames not matching the background
+        self._initialized = False
+
+    def update(self, range_mm, valid):
+        """
+        Classifies the returns of a scan and updates the model. Returns the (h, w) bool foreground mask.
+        """
+        range_mm = range_mm.astype(np.float32)
+        if not self._initialized:
+            # The first scan is the initial background
+            self.background[valid] = range_mm[valid]
+            self._initialized = True
+            return np.zeros(valid.shape, bool)
+
+        known = self.background > 0
+        tolerance = np.maximum(self.background * self.tolerance, self.min_tolerance_mm)
+        match = valid & known & (np.abs(range_mm - self.background) <= tolerance)
+        foreground = valid & ~match
+
+        # Follow slow changes on the matching pixels, learn the pixels seen for the first time
+        self.background[match] += self.learning_rate * (range_mm[match] - self.background[match])
+        new = valid & ~known
+        self.background[new] = range_mm[new]
+
+        # Pixels that keep disagreeing with the background for long enough become the new background
+        self._mismatch[match] = 0
+        mismatch = foreground & known
+        self._mismatch[mismatch] += 1
+        relearn = self._mismatch >= self.relearn_frames
+        if relearn.any():
+            self.background[relearn] = range_mm[relearn]
+            self._mismatch[relearn] = 0
+        return foreground
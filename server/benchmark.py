@@ -0,0 +1,384 @@
+"""
+Benchmarks for the scan processing.
+
+    python benchmark.py layout [--runs 50] [--output results.json]
+    python benchmark.py pipeline (--source scans.pcap | --metadata sensor.json) [--stub-model] [--output results.json]
+    python benchmark.py backends --source site.pcap [--models pytorch:l onnx:n onnx:n:int8 openvino:s:int8]
+
+layout: compares the memory and per-scan inference latency of three independent YOLO models tracking one channel
+each ("separate", the previous layout of ScanIterator) against one shared model running the three channels as a
+single batch with a tracker per channel ("shared", the current layout). Every layout runs in its own process so
+that the memory figures do not influence each other.
+
+pipeline: drives ScanIterator over a PCAP/OSF recording or over synthetic scans generated from a sensor metadata
+file, and reports the fps, the per-stage latencies (ScanFrame.timings plus the websocket encoding) and the peak
+memory. With --stub-model the YOLO model is replaced by StubModel, so it runs on CPU without weights (e.g. in CI).
+
+backends: runs every model (backend:size[:int8], see backends.py) on the same preprocessed scans of a recording and
+reports its inference latency and its accuracy against the first model of the list, taken as reference: precision,
+recall and F1 of the person boxes matched at IoU >= 0.5, and the mean IoU of the matched boxes.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
+
+
+def rss_mb():
+    # Current resident set size, falling back to the peak one where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def latency_summary(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {
+        "mean_ms": float(np.mean(ms)),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+def _run_layout(layout, weights, channels, height, width, warmup, runs):
+    import torch
+    from ultralytics import YOLO
+    from server import ScanIterator, make_tracker, track_results
+
+    device = ScanIterator.DEVICE
+    rss_before = rss_mb()
+    if layout == "separate":
+        models = [YOLO(weights).to(device=device) for _ in range(channels)]
+    else:
+        models = [YOLO(weights).to(device=device)]
+        trackers = [make_tracker() for _ in range(channels)]
+    person = [k for k, v in models[0].names.items() if v == "person"]
+    rss_loaded = rss_mb()
+
+    rng = np.random.default_rng(0)
+    batch = [rng.integers(0, 256, (height, width, 3), np.uint8) for _ in range(channels)]
+    latencies = []
+    for run in range(warmup + runs):
+        start = time.perf_counter()
+        if layout == "separate":
+            for model, img in zip(models, batch):
+                next(model.track([img], stream=True, persist=True, conf=0.25, imgsz=[height, width],
+                                 classes=person, verbose=False)).cpu()
+        else:
+            results = models[0].predict(batch, conf=0.25, imgsz=[height, width], classes=person, verbose=False)
+            for tracker, result in zip(trackers, results):
+                track_results(tracker, result.cpu())
+        if run >= warmup:
+            latencies.append(time.perf_counter() - start)
+
+    report = {
+        "layout": layout,
+        "device": device,
+        "models": len(models),
+        "parameters": sum(p.numel() for model in models for p in model.model.parameters()),
+        "rss_models_mb": rss_loaded - rss_before,
+        "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+        "per_scan": latency_summary(latencies),
+    }
+    if device == "cuda":
+        report["cuda_peak_mb"] = torch.cuda.max_memory_allocated() / 2**20
+    return report
+
+
+def benchmark_layout(args):
+    ctx = multiprocessing.get_context("spawn")
+    reports = []
+    for layout in ("separate", "shared"):
+        with ctx.Pool(1) as pool:
+            reports.append(pool.apply(_run_layout, (layout, args.weights, args.channels, args.height, args.width,
+                                                     args.warmup, args.runs)))
+    return {"benchmark": "layout", "height": args.height, "width": args.width, "runs": args.runs,
+            "layouts": reports}
+
+
+class SyntheticScans:
+    """
+    Source of synthetic LidarScans for the sensor described by metadata: a static scene with a bright person-sized
+    blob walking across it, and column timestamps at the nominal frame rate.
+    """
+
+    def __init__(self, metadata, count, seed=0):
+        self.metadata = metadata
+        self.count = count
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        from ouster.sdk.client import ChanField, LidarScan
+
+        fmt = self.metadata.format
+        h, w = fmt.pixels_per_column, fmt.columns_per_frame
+        period_ns = int(1e9 / (fmt.fps or 10))
+        rows = np.arange(h, dtype=np.float64)[:, None]
+        static_range = np.broadcast_to(np.interp(rows, [0, h - 1], [40000, 3000]), (h, w))
+        person_rows = slice(h // 3, 2 * h // 3)
+        person_cols = max(w // 50, 4)
+
+        for k in range(self.count):
+            scan = LidarScan(h, w, fmt.udp_profile_lidar, fmt.columns_per_packet)
+            scan.frame_id = k
+            scan.timestamp[:] = (k + 1) * period_ns + np.arange(w, dtype=np.uint64) * (period_ns // w)
+            scan.status[:] = 1
+
+            range_mm = static_range + self._rng.normal(0, 20, (h, w))
+            reflectivity = self._rng.integers(10, 80, (h, w))
+            col = (k * person_cols // 4) % (w - person_cols)
+            range_mm[person_rows, col:col + person_cols] = 8000
+            reflectivity[person_rows, col:col + person_cols] = 255
+
+            fields = {ChanField.RANGE: range_mm, ChanField.REFLECTIVITY: reflectivity,
+                      ChanField.SIGNAL: reflectivity * 4, ChanField.NEAR_IR: reflectivity * 8}
+            for field, values in fields.items():
+                if field in scan.fields:
+                    data = scan.field(field)
+                    data[:] = np.clip(values, 0, np.iinfo(data.dtype).max).astype(data.dtype)
+            yield scan
+
+
+class StubModel:
+    """
+    Stand-in for the YOLO segmentation model: "detects" a person on every large enough connected region of
+    saturated pixels, so the whole pipeline (tracking, masks, statistics) runs without weights or GPU.
+    """
+    names = {0: "person"}
+
+    def __init__(self, threshold=250, min_area=20):
+        self.threshold = threshold
+        self.min_area = min_area
+
+    def predict(self, batch, conf=0.25, imgsz=None, classes=None, **kwargs):
+        import cv2
+        import torch
+        from ultralytics.engine.results import Results
+
+        results = []
+        for img in batch:
+            n, labels, stats, _ = cv2.connectedComponentsWithStats((img[..., 0] >= self.threshold).astype(np.uint8))
+            keep = [label for label in range(1, n) if stats[label, cv2.CC_STAT_AREA] >= self.min_area]
+            boxes = [[x, y, x + bw, y + bh, 0.9, 0] for x, y, bw, bh, _ in stats[keep]]
+            masks = None
+            if keep:
+                masks = torch.from_numpy(np.stack([labels == label for label in keep]).astype(np.float32))
+            results.append(Results(img, path="", names=self.names, masks=masks,
+                                   boxes=torch.tensor(boxes, dtype=torch.float32).reshape(-1, 6)))
+        return results
+
+
+def benchmark_pipeline(args):
+    from ouster.sdk import open_source
+    from ouster.sdk.client import SensorInfo
+    from image_codec import ImageEncoder
+    from server import ScanIterator, parse_channels
+    from topics import Demand, Subscription
+
+    if args.source is not None:
+        source = open_source(args.source, sensor_idx=0, cycle=True)
+    else:
+        with open(args.metadata) as f:
+            source = SyntheticScans(SensorInfo(f.read()), args.warmup + args.scans)
+
+    if args.stub_model:
+        model = StubModel()
+    else:
+        from ultralytics import YOLO
+        model = YOLO(args.weights).to(device=ScanIterator.DEVICE)
+
+    rss_before = rss_mb()
+    image_encoder = ImageEncoder(args.image_codec, workers=args.encoder_threads)
+    scans = ScanIterator(source, model=model, image_encoder=image_encoder, background=args.background,
+                         channels=parse_channels(args.channels), headless=True if args.headless else ())
+    stages = scans.stages()
+    # Headless, only what an alarm client subscribed to detections receives is encoded
+    demand = Demand([Subscription(("detections", "frame"))]) if args.headless else None
+
+    timings = {}
+    totals = []
+    start = None
+    for k, scan in enumerate(itertools.islice(scans.source, args.warmup + args.scans)):
+        if k == args.warmup:
+            start = time.perf_counter()
+        scan_start = time.perf_counter()
+        frame = scan
+        for _, stage in stages:
+            frame = stage(frame)
+        scans.encode_results(frame, demand)
+        if k >= args.warmup:
+            totals.append(time.perf_counter() - scan_start)
+            for name, seconds in frame.timings.items():
+                timings.setdefault(name, []).append(seconds)
+    elapsed = time.perf_counter() - start if start is not None else 0.0
+    image_encoder.shutdown()
+
+    fmt = source.metadata.format
+    return {
+        "benchmark": "pipeline",
+        "source": args.source or f"synthetic:{args.metadata}",
+        "model": "stub" if args.stub_model else args.weights,
+        "device": "cpu" if args.stub_model else ScanIterator.DEVICE,
+        "height": fmt.pixels_per_column,
+        "width": fmt.columns_per_frame,
+        "channels": args.channels,
+        "background": args.background,
+        "headless": args.headless,
+        "image_codec": args.image_codec,
+        "scans": len(totals),
+        "fps": len(totals) / elapsed if elapsed > 0 else 0.0,
+        "rss_pipeline_mb": rss_mb() - rss_before,
+        "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+        "per_scan": latency_summary(totals) if totals else {},
+        "stages": {name: latency_summary(seconds) for name, seconds in timings.items()},
+    }
+
+
+def _run_backend(spec, source, scans, channels, model_dir, warmup):
+    from backends import load_model, parse_spec, model_path
+    from export_model import lidar_frames
+
+    backend, size, int8 = parse_spec(spec)
+    model = load_model(size, backend, int8, model_dir, device="cpu")
+    person = [k for k, v in model.names.items() if v == "person"]
+    path = model_path(size, backend, int8, model_dir)
+    if os.path.isdir(path):
+        model_mb = sum(entry.stat().st_size for entry in os.scandir(path)) / 2**20
+    else:
+        model_mb = os.path.getsize(path) / 2**20
+
+    latencies = []
+    boxes = []
+    for k, batch in enumerate(lidar_frames(source, warmup + scans, channels=channels)):
+        start = time.perf_counter()
+        results = model.predict(batch, conf=0.25, imgsz=list(batch[0].shape[:2]), classes=person, verbose=False)
+        elapsed = time.perf_counter() - start
+        if k >= warmup:
+            latencies.append(elapsed)
+            boxes.append([r.boxes.xyxy.cpu().numpy() for r in results])
+    report = {
+        "model": spec,
+        "model_mb": model_mb,
+        "per_scan": latency_summary(latencies),
+        "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+    }
+    return report, boxes
+
+
+def box_iou(a, b):
+    # IoU matrix of two (N, 4) and (M, 4) xyxy box arrays
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def match_boxes(reference, candidate, threshold=0.5):
+    # Greedy one-to-one matching by decreasing IoU, returns (true positives, false positives, false negatives, IoUs)
+    if len(reference) == 0 or len(candidate) == 0:
+        return 0, len(candidate), len(reference), []
+    iou = box_iou(reference, candidate)
+    ious = []
+    for flat in np.argsort(iou, axis=None)[::-1]:
+        r, c = np.unravel_index(flat, iou.shape)
+        if iou[r, c] < threshold:
+            break
+        ious.append(float(iou[r, c]))
+        iou[r, :] = -1
+        iou[:, c] = -1
+    return len(ious), len(candidate) - len(ious), len(reference) - len(ious), ious
+
+
+def benchmark_backends(args):
+    ctx = multiprocessing.get_context("spawn")
+    runs = []
+    for spec in args.models:
+        with ctx.Pool(1) as pool:
+            runs.append(pool.apply(_run_backend, (spec, args.source, args.scans, args.channels, args.model_dir,
+                                                   args.warmup)))
+
+    reference_boxes = runs[0][1]
+    reports = []
+    for report, boxes in runs:
+        tp = fp = fn = 0
+        ious = []
+        for reference_scan, scan in zip(reference_boxes, boxes):
+            for reference, candidate in zip(reference_scan, scan):
+                t, p, n, matched = match_boxes(reference, candidate)
+                tp, fp, fn = tp + t, fp + p, fn + n
+                ious += matched
+        precision = tp / (tp + fp) if tp + fp else 1.0
+        recall = tp / (tp + fn) if tp + fn else 1.0
+        report["accuracy"] = {
+            "reference": args.models[0],
+            "precision": precision,
+            "recall": recall,
+            "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+            "mean_iou": float(np.mean(ious)) if ious else None,
+            "reference_boxes": tp + fn,
+        }
+        reports.append(report)
+    return {"benchmark": "backends", "source": args.source, "scans": args.scans, "channels": args.channels,
+            "models": reports}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='benchmark', description='Benchmarks for the scan processing')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON report to this file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    layout = subparsers.add_parser('layout', help='Separate models per channel versus one shared batched model')
+    layout.add_argument('--weights', type=str, default='yolo11l-seg.pt')
+    layout.add_argument('--channels', type=int, default=3)
+    layout.add_argument('--height', type=int, default=128, help='Image height (sensor beams)')
+    layout.add_argument('--width', type=int, default=2048, help='Image width (columns per frame)')
+    layout.add_argument('--warmup', type=int, default=3)
+    layout.add_argument('--runs', type=int, default=30)
+    layout.set_defaults(run=benchmark_layout)
+
+    pipeline = subparsers.add_parser('pipeline', help='Per-stage latency of ScanIterator on recorded or synthetic scans')
+    source = pipeline.add_mutually_exclusive_group(required=True)
+    source.add_argument('--source', type=str, help='PCAP or OSF file to replay (looped when shorter than --scans)')
+    source.add_argument('--metadata', type=str, help='Sensor metadata JSON used to generate synthetic scans')
+    pipeline.add_argument('--stub-model', action='store_true', help='Replace YOLO with a CPU stub model')
+    pipeline.add_argument('--weights', type=str, default='yolo11l-seg.pt')
+    pipeline.add_argument('--channels', type=str, default='NEAR_IR,REFLECTIVITY,SIGNAL',
+                          help='Channel set and cadence, as in server.py --channels')
+    pipeline.add_argument('--background', action='store_true', help='Enable the static background model')
+    pipeline.add_argument('--headless', action='store_true',
+                          help='Headless channels, encoding only the detections and frame messages')
+    pipeline.add_argument('--image-codec', type=str, default='jpeg')
+    pipeline.add_argument('--encoder-threads', type=int, default=2)
+    pipeline.add_argument('--warmup', type=int, default=10)
+    pipeline.add_argument('--scans', type=int, default=200)
+    pipeline.set_defaults(run=benchmark_pipeline)
+
+    backends = subparsers.add_parser('backends', help='Accuracy versus latency of the inference backends')
+    backends.add_argument('--source', type=str, required=True, help='PCAP or OSF recording of the site')
+    backends.add_argument('--models', nargs='+', default=['pytorch:l', 'pytorch:n', 'onnx:n', 'onnx:n:int8'],
+                          help='backend:size[:int8] models to compare, the first one is the accuracy reference')
+    backends.add_argument('--model-dir', type=str, default='.', help='Directory of the exported models')
+    backends.add_argument('--channels', type=str, default='NEAR_IR,REFLECTIVITY,SIGNAL')
+    backends.add_argument('--warmup', type=int, default=3)
+    backends.add_argument('--scans', type=int, default=100)
+    backends.set_defaults(run=benchmark_backends)
+
+    args = parser.parse_args()
+    report = args.run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,137 @@
+"""
+One-time export of the YOLO segmentation model for the ONNX Runtime and OpenVINO backends (see backends.py).
+
+    python export_model.py --size n --backend onnx
+    python export_model.py --size s --backend openvino --int8 --calibration site.pcap
+
+INT8 quantization is calibrated on the same camera-like LiDAR images the server feeds to the model (destaggered,
+exposure corrected channels of a local recording), not on the COCO photos the weights were trained on.
+"""
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+
+import cv2
+import numpy as np
+
+from backends import BACKENDS, MODEL_SIZES, model_path, weights_name
+
+
+def lidar_frames(source, count, stride=1, channels="NEAR_IR,REFLECTIVITY,SIGNAL", model=None):
+    """
+    Yields the YOLO input images (uint8 RGB) of the channels of every stride-th scan of a PCAP/OSF recording, up to
+    count scans, preprocessed exactly like ScanIterator does. Yields one list of images per scan.
+    """
+    from ouster.sdk import open_source
+    from server import ScanIterator, parse_channels
+
+    if model is None:
+        from benchmark import StubModel
+        model = StubModel()
+    scans = ScanIterator(open_source(source, sensor_idx=0, cycle=True), model=model,
+                         channels=parse_channels(channels))
+    for scan in itertools.islice(scans.source, 0, count * stride, stride):
+        frame = scans.preprocess(scans.ingest(scan))
+        yield [img for img in frame.img_rgb if img is not None]
+
+
+class _CalibrationReader:
+    # onnxruntime.quantization.CalibrationDataReader over LiDAR images, preprocessed like ultralytics does
+    def __init__(self, images, input_name):
+        self._images = iter(images)
+        self._input_name = input_name
+
+    def get_next(self):
+        img = next(self._images, None)
+        if img is None:
+            return None
+        return {self._input_name: np.ascontiguousarray(img[..., ::-1].transpose(2, 0, 1))[None].astype(np.float32) / 255}
+
+    def rewind(self):
+        pass
+
+
+def export_onnx(model, imgsz, int8, calibration_images, output):
+    exported = model.export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+    if not int8:
+        shutil.move(exported, output)
+        return output
+
+    import onnx
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class Reader(_CalibrationReader, CalibrationDataReader):
+        pass
+
+    prepared = exported.replace(".onnx", "_prep.onnx")
+    quant_pre_process(exported, prepared)
+    input_name = onnx.load(prepared).graph.input[0].name
+    quantize_static(prepared, output, Reader(calibration_images, input_name), quant_format=QuantFormat.QDQ,
+                    per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+    # ultralytics reads the task, class names and image size from the metadata of the model
+    quantized = onnx.load(output)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(onnx.load(exported).metadata_props)
+    onnx.save(quantized, output)
+    os.remove(prepared)
+    os.remove(exported)
+    return output
+
+
+def export_openvino(model, imgsz, int8, calibration_images, output):
+    with tempfile.TemporaryDirectory() as tmp:
+        data = None
+        if int8:
+            # ultralytics calibrates OpenVINO's NNCF on a dataset: the LiDAR images, without labels
+            os.makedirs(os.path.join(tmp, "images"))
+            for i, img in enumerate(calibration_images):
+                cv2.imwrite(os.path.join(tmp, "images", f"{i:05d}.png"), img)
+            data = os.path.join(tmp, "lidar.yaml")
+            with open(data, "w") as f:
+                f.write(f"path: {tmp}\ntrain: images\nval: images\nnames:\n")
+                f.writelines(f"  {k}: {v}\n" for k, v in model.names.items())
+        exported = model.export(format="openvino", imgsz=imgsz, dynamic=True, int8=int8, data=data)
+    if os.path.abspath(exported) != os.path.abspath(output):
+        shutil.rmtree(output, ignore_errors=True)
+        shutil.move(exported, output)
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='export_model', description='Exports YOLO for the CPU inference backends')
+    parser.add_argument('--size', choices=MODEL_SIZES, default='l', help='Model size')
+    parser.add_argument('--backend', choices=[b for b in BACKENDS if b != 'pytorch'], required=True)
+    parser.add_argument('--int8', action='store_true', help='Quantize to INT8, calibrated on --calibration')
+    parser.add_argument('--calibration', type=str, default=None,
+                        help='PCAP or OSF recording of the site used to calibrate the INT8 quantization')
+    parser.add_argument('--calibration-scans', type=int, default=100, help='Scans used for calibration')
+    parser.add_argument('--calibration-stride', type=int, default=5,
+                        help='Use one scan out of this many, to cover more of the recording')
+    parser.add_argument('--channels', type=str, default='NEAR_IR,REFLECTIVITY,SIGNAL',
+                        help='Channels whose images are used for calibration, as in server.py --channels')
+    parser.add_argument('--imgsz', type=int, nargs=2, default=None, metavar=('HEIGHT', 'WIDTH'),
+                        help='Export image size, by default the size of the calibration scans or 128 2048')
+    parser.add_argument('--output-dir', type=str, default='.', help='Where the exported model is written')
+    args = parser.parse_args()
+
+    if args.int8 and not args.calibration:
+        parser.error('--int8 requires --calibration')
+
+    from ultralytics import YOLO
+    model = YOLO(weights_name(args.size))
+
+    images = []
+    if args.calibration:
+        for scan_images in lidar_frames(args.calibration, args.calibration_scans, args.calibration_stride,
+                                        args.channels, model=model):
+            images += scan_images
+    imgsz = args.imgsz or (list(images[0].shape[:2]) if images else [128, 2048])
+
+    output = model_path(args.size, args.backend, args.int8, args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+    export = export_onnx if args.backend == 'onnx' else export_openvino
+    print(export(model, imgsz, args.int8, images, output))
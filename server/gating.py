@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class MotionGate:
+    """
+    Cheap change detector deciding whether a scan needs inference. The range and reflectivity images are compared,
+    on a subsampled grid, against the last scan inference ran on, so slow movements add up until they trigger it.
+
+    min_changed_pixels: changed grid pixels needed to run inference
+    range_tolerance: relative range difference ignored as noise
+    reflectivity_tolerance: absolute reflectivity difference ignored as noise
+    stride: subsampling step of the comparison grid, along rows and columns
+    hold_frames: frames to keep running at full rate after the last change
+    idle_interval: with no change, still run inference every this many scans (0 = never)
+    """
+
+    def __init__(self, min_changed_pixels=20, range_tolerance=0.05, reflectivity_tolerance=20, stride=2,
+                 hold_frames=10, idle_interval=0):
+        self.min_changed_pixels = min_changed_pixels
+        self.range_tolerance = range_tolerance
+        self.reflectivity_tolerance = reflectivity_tolerance
+        self.stride = stride
+        self.hold_frames = hold_frames
+        self.idle_interval = idle_interval
+        self._reference = None
+        self._since_change = 0
+        self._since_inference = 0
+        self.evaluated = 0  # scans checked
+        self.skipped = 0  # scans on which inference was skipped
+
+    def check(self, range_mm, reflectivity):
+        """
+        Returns True when inference has to run on this scan. Both images are destaggered (h, w) arrays.
+        """
+        self.evaluated += 1
+        range_mm = range_mm[::self.stride, ::self.stride].astype(np.float32)
+        reflectivity = reflectivity[::self.stride, ::self.stride].astype(np.float32)
+
+        if self._reference is None:
+            changed = True
+        else:
+            reference_range, reference_reflectivity = self._reference
+            range_change = np.abs(range_mm - reference_range) > self.range_tolerance * np.maximum(reference_range, 1000)
+            reflectivity_change = np.abs(reflectivity - reference_reflectivity) > self.reflectivity_tolerance
+            changed = np.count_nonzero(range_change | reflectivity_change) >= self.min_changed_pixels
+
+        self._since_change = 0 if changed else self._since_change + 1
+        run = (self._since_change <= self.hold_frames
+               or (self.idle_interval > 0 and self._since_inference + 1 >= self.idle_interval))
+        if run:
+            self._reference = (range_mm, reflectivity)
+            self._since_inference = 0
+        else:
+            self._since_inference += 1
+            self.skipped += 1
+        return run
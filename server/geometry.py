@@ -0,0 +1,101 @@
+import numpy as np
+from ouster.sdk.client import ChanField, LidarScan, SensorInfo, XYZLut
+
+
+class ScanGeometry:
+    """
+    Destaggered (human-viewable) XYZ, range and validity of a single scan. Computed once per scan and shared by
+    all the channel passes and by the websocket encoder.
+    """
+
+    def __init__(self, xyz, range_mm, valid):
+        self.xyz = xyz  # (h, w, 3) float64, meters
+        self.range_mm = range_mm  # (h, w) uint32, millimeters
+        self.valid = valid  # (h, w) bool, pixels with a return
+        self._valid_xyz = None
+        self._valid_pixels = None
+
+    @property
+    def valid_xyz(self):
+        # (N, 3) xyz of the pixels with a return, in row-major image order
+        if self._valid_xyz is None:
+            self._valid_xyz = self.xyz[self.valid]
+        return self._valid_xyz
+
+    @property
+    def valid_pixels(self):
+        # (N,) flat image index of the pixels with a return, same order as valid_xyz
+        if self._valid_pixels is None:
+            self._valid_pixels = np.flatnonzero(self.valid)
+        return self._valid_pixels
+
+
+class GeometryCache:
+    """
+    Computes ScanGeometry objects into preallocated buffers, destaggering with index maps precomputed from the
+    metadata. `buffers` sets how many geometries can be alive at the same time: the buffers are reused in a ring,
+    so it must be at least the number of frames in flight in the pipeline.
+
+    extrinsics: optional 4x4 sensor to station transform (meters). The xyz are then in the common station frame
+    shared by all the sensors of a multi-sensor setup, instead of the sensor frame.
+    """
+
+    def __init__(self, metadata: SensorInfo, xyzlut=None, buffers=1, extrinsics=None):
+        self.h = metadata.format.pixels_per_column
+        self.w = metadata.format.columns_per_frame
+        self._xyzlut = xyzlut if xyzlut is not None else XYZLut(metadata)
+        self._rotation = None
+        self._translation = None
+        if extrinsics is not None:
+            extrinsics = np.asarray(extrinsics, np.float64)
+            if extrinsics.shape != (4, 4):
+                raise ValueError(f"extrinsics: attesa una matrice 4x4, non {extrinsics.shape}")
+            # Transposed once, so that xyz @ rotation maps row vectors
+            self._rotation = np.ascontiguousarray(extrinsics[:3, :3].T)
+            self._translation = extrinsics[:3, 3].copy()
+
+        # destaggered[u, v] = staggered[u, (v - shift[u]) % w], and the other way round for the inverse
+        shifts = np.asarray(metadata.format.pixel_shift_by_row, np.int64)[:, np.newaxis]
+        rows = np.arange(self.h, dtype=np.int64)[:, np.newaxis] * self.w
+        columns = np.arange(self.w, dtype=np.int64)[np.newaxis, :]
+        self._destagger_index = (rows + (columns - shifts) % self.w).ravel()
+        self._stagger_index = (rows + (columns + shifts) % self.w).ravel()
+
+        self._buffers = []
+        self._next_buffer = 0
+        self.reserve(buffers)
+
+    def reserve(self, buffers):
+        # Makes sure that at least `buffers` geometries can be alive at the same time
+        while len(self._buffers) < buffers:
+            self._buffers.append([np.empty((self.h, self.w, 3), np.float64), np.empty((self.h, self.w), np.uint32),
+                                  np.empty((self.h, self.w), bool)])
+
+    def destagger(self, img, inverse=False, out=None):
+        """
+        Same as ouster.sdk.client.destagger for (h, w) and (h, w, c) images, optionally writing into `out`.
+        """
+        index = self._stagger_index if inverse else self._destagger_index
+        flat = img.reshape(self.h * self.w, -1) if img.ndim == 3 else img.reshape(self.h * self.w)
+        if out is None:
+            return np.take(flat, index, axis=0).reshape(img.shape)
+        np.take(flat, index, axis=0, out=out.reshape(flat.shape))
+        return out
+
+    def compute(self, scan: LidarScan) -> ScanGeometry:
+        buffer = self._buffers[self._next_buffer]
+        self._next_buffer = (self._next_buffer + 1) % len(self._buffers)
+
+        staggered_range = scan.field(ChanField.RANGE)
+        if buffer[1].dtype != staggered_range.dtype:
+            # The range field is not uint32 with every lidar profile
+            buffer[1] = np.empty((self.h, self.w), staggered_range.dtype)
+        xyz, range_mm, valid = buffer
+        self.destagger(self._xyzlut(staggered_range), out=xyz)
+        if self._rotation is not None:
+            flat = xyz.reshape(-1, 3)
+            flat[:] = flat @ self._rotation
+            flat += self._translation
+        self.destagger(staggered_range, out=range_mm)
+        np.not_equal(range_mm, 0, out=valid)  # Ignore non-detected points
+        return ScanGeometry(xyz, range_mm, valid)
@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+import wire
+from topics import TOPICS, Demand, FrameProducts, Subscription
+
+
+class Subscriber:
+    """
+    A websocket client attached to a BroadcastHub. Frames are queued in a small bounded queue; when the client
+    is too slow to keep up, the oldest queued frame is dropped so the client always catches up to the latest one.
+    Only the topics and variants of its Subscription are queued, at most at its max_rate per sensor.
+    """
+
+    def __init__(self, websocket, max_queue=2):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.paused = False
+        self.subscription = Subscription()
+        self.sent = 0  # frames fully sent to the client
+        self.dropped = 0  # frames discarded because the client was too slow
+        self.skipped = 0  # frames skipped to respect max_rate
+        self._pending_keyframes = {}  # sensor -> static keyframe of a skipped frame, sent with the next one
+
+    def offer(self, products):
+        # Returns True when a queued frame had to be dropped to make room
+        if self.paused:
+            return False
+        if not isinstance(products, FrameProducts):
+            products = FrameProducts.from_messages(products)
+        messages = products.select(self.subscription)
+        now = time.monotonic()
+        if products.rate_limited:
+            # Decided once: by the encode stage for the frames it tagged, here for the others
+            if products.subscriptions is not None:
+                due = any(s is self.subscription for s in products.subscriptions)
+            else:
+                due = self.subscription.due(now, products.sensor)
+            if not due:
+                # The static background must not be lost with the frame that carried it
+                for message in messages:
+                    if wire.is_keyframe(message):
+                        self._pending_keyframes[message[2]] = message
+                self.skipped += 1
+                return False
+        if self._pending_keyframes and "points" in self.subscription.topics:
+            fresh = {message[2] for message in messages if wire.is_keyframe(message)}
+            messages = [m for sensor, m in self._pending_keyframes.items() if sensor not in fresh] + messages
+            self._pending_keyframes.clear()
+        if not messages:
+            return False
+        dropped = self.queue.full()
+        if dropped:
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(messages)
+        if products.rate_limited:
+            # Only a frame actually queued uses up the slot of the subscriber
+            self.subscription.sent(now, products.sensor)
+        return dropped
+
+    def push(self, messages):
+        # Queues messages the client asked for (e.g. the static keyframes), regardless of its rate and topics.
+        # Returns True when a queued frame had to be dropped to make room
+        sensors = {message[2] for message in messages if wire.is_keyframe(message)}
+        self._pending_keyframes = {s: m for s, m in self._pending_keyframes.items() if s not in sensors}
+        dropped = self.queue.full()
+        if dropped:
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(list(messages))
+        return dropped
+
+    async def run(self):
+        while True:
+            messages = await self.queue.get()
+            for message in messages:
+                await self.websocket.send(message)
+            self.sent += 1
+
+
+class BroadcastHub:
+    """
+    Fans out every frame produced by a single producer to any number of subscribers. publish() never blocks, so
+    a slow client cannot throttle the producer or the other clients. demand holds the union of the subscriptions
+    of the active clients, so the producer only encodes what someone will receive.
+    """
+
+    def __init__(self, max_queue=2):
+        self._max_queue = max_queue
+        self.subscribers = set()
+        self.demand = Demand()
+        self.published = 0  # frames published
+        self.dropped = 0  # frames dropped by slow subscribers, over all the subscribers ever connected
+
+    def subscribe(self, websocket):
+        subscriber = Subscriber(websocket, self._max_queue)
+        self.subscribers.add(subscriber)
+        self.update_demand()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        self.update_demand()
+
+    def update_demand(self):
+        # To be called whenever a subscription changes or a subscriber is paused or resumed. The attribute is
+        # replaced, never modified, so the pipeline threads can read it at any time
+        self.demand = Demand(s.subscription for s in self.subscribers if not s.paused)
+
+    def topic_counts(self):
+        return {topic: sum(topic in s.subscription.topics for s in self.subscribers) for topic in TOPICS}
+
+    def publish(self, messages):
+        # A frame is a FrameProducts, or a list of websocket messages (str for JSON, bytes-like for binary) that is
+        # sent to every subscriber of their topics
+        if not isinstance(messages, FrameProducts):
+            messages = FrameProducts.from_messages(messages)
+        self.published += 1
+        for subscriber in self.subscribers:
+            self.dropped += subscriber.offer(messages)
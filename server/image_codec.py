@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import wire
+
+CODECS = {
+    "png": (wire.CODEC_PNG, ".png"),
+    "jpeg": (wire.CODEC_JPEG, ".jpg"),
+    "webp": (wire.CODEC_WEBP, ".webp"),
+}
+
+
+class ImageEncoder:
+    """
+    Encodes RGB uint8 images to PNG, JPEG or WebP on a pool of worker threads (OpenCV releases the GIL while
+    encoding), so that the images of a frame are encoded in parallel and only once for all the clients.
+    """
+
+    def __init__(self, codec="png", quality=85, workers=2):
+        self.codec, self._extension = CODECS[codec]
+        if codec == "jpeg":
+            self._params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        elif codec == "webp":
+            self._params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+        else:
+            self._params = [cv2.IMWRITE_PNG_COMPRESSION, 1]  # Favour speed over size
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-encoder")
+
+    def _encode(self, img_rgb: np.ndarray) -> bytes:
+        ok, data = cv2.imencode(self._extension, cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR), self._params)
+        if not ok:
+            raise RuntimeError(f"Codifica {self._extension} non riuscita")
+        return data.tobytes()
+
+    def submit(self, img_rgb: np.ndarray):
+        # Returns a Future with the encoded image file
+        return self._pool.submit(self._encode, img_rgb)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
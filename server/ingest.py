@@ -0,0 +1,86 @@
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+_END = object()  # Marks the end of the source
+
+
+class ScanPrefetcher:
+    """
+    Reads a ScanSource in its own thread into a small ring of complete scans, so that the sensor is drained while
+    the pipeline is busy (a live sensor not read for the duration of an inference loses UDP packets, which shows up
+    as partial scans). When the ring is full the oldest scan is dropped: with the default size of 1 the pipeline
+    always gets the freshest complete scan, a larger ring absorbs bursts at the cost of latency.
+
+    Incomplete scans (columns missing in the azimuth window of the sensor) are counted and discarded. Iterating the
+    prefetcher blocks until a scan is available, and ends with the source or on close(), which also closes the
+    source.
+    """
+
+    def __init__(self, source, size=1):
+        self.source = source
+        self.metadata = source.metadata
+        self._window = source.metadata.format.column_window
+        self._ring = deque(maxlen=size)
+        self._ready = threading.Condition()
+        self._stop = threading.Event()
+        self.received = 0  # scans read from the source
+        self.dropped = 0  # complete scans overwritten before the pipeline took them
+        self.incomplete = 0  # scans discarded because partial
+        self._thread = threading.Thread(target=self._read, name="sensor-ingest", daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._ring)
+
+    def __iter__(self):
+        while True:
+            with self._ready:
+                while not self._ring and not self._stop.is_set():
+                    self._ready.wait()
+                if self._stop.is_set():
+                    return
+                scan = self._ring.popleft()
+            if scan is _END:
+                return
+            yield scan
+
+    def close(self):
+        self._stop.set()
+        with self._ready:
+            self._ready.notify_all()
+        # The reader thread notices the stop with the next scan. Closing the source unblocks it when the sensor sends
+        # nothing
+        self._thread.join(timeout=0.5)
+        self.source.close()
+        self._thread.join(timeout=1.0)
+
+    def _push(self, item):
+        with self._ready:
+            if len(self._ring) == self._ring.maxlen:
+                self.dropped += 1
+            self._ring.append(item)
+            self._ready.notify()
+
+    def _read(self):
+        try:
+            for scan in self.source:
+                if self._stop.is_set():
+                    break
+                self.received += 1
+                if scan is None or not scan.complete(self._window):
+                    if not self.incomplete:
+                        logger.warning("Scansione incompleta dal sensore: pacchetti UDP persi?")
+                    self.incomplete += 1
+                    continue
+                self._push(scan)
+        except Exception:
+            if not self._stop.is_set():
+                logger.exception("Errore nella lettura del sensore")
+        # The end marker must not be dropped by a full ring, nor drop a scan still to be processed
+        with self._ready:
+            self._ring = deque(self._ring, maxlen=len(self._ring) + 1)
+            self._ring.append(_END)
+            self._ready.notify()
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class InstanceStats:
+    """
+    Per-instance statistics of a label image, one row per instance with at least one valid point. Rows are
+    sorted by instance id.
+    """
+
+    def __init__(self, ids, counts, median_xyz, mean_xyz, median_range_mm, closest_pixel):
+        self.ids = ids  # (K,) instance ids
+        self.counts = counts  # (K,) number of valid points of the instance
+        self.median_xyz = median_xyz  # (K, 3) per-axis median of the instance points, meters
+        self.mean_xyz = mean_xyz  # (K, 3) mean of the instance points, meters
+        self.median_range_mm = median_range_mm  # (K,) median range of the instance points
+        self.closest_pixel = closest_pixel  # (K, 2) (row, column) of the instance point closest to median_xyz
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+
+def _segment_medians(values, labels, starts, counts):
+    # Median of every run of equal labels, computed like np.median (mean of the two middle values for even runs)
+    ordered = values[np.lexsort((values, labels))]
+    lower = ordered[starts + (counts - 1) // 2]
+    upper = ordered[starts + counts // 2]
+    return (lower + upper) / 2
+
+
+def instance_statistics(instance_id_img, xyz, range_mm, valid) -> InstanceStats:
+    """
+    Computes the InstanceStats of every non-zero label of `instance_id_img` in a single pass over the labeled
+    pixels, so the cost does not grow with the number of instances in the scene.
+
+    instance_id_img: (h, w) integer label image, 0 is background
+    xyz: (h, w, 3) point coordinates
+    range_mm: (h, w) range image
+    valid: (h, w) bool, pixels with a return
+    """
+    pixels = np.flatnonzero((instance_id_img != 0) & valid)
+    labels = instance_id_img.ravel()[pixels]
+    points = xyz.reshape(-1, 3)[pixels]
+
+    # Group the pixels by label: starts/counts describe the runs of each label once sorted by label
+    order = np.argsort(labels, kind="stable")
+    pixels, labels, points = pixels[order], labels[order], points[order]
+    ids, starts, inverse, counts = np.unique(labels, return_index=True, return_inverse=True, return_counts=True)
+
+    median_xyz = np.empty((ids.shape[0], 3), np.float64)
+    for axis in range(3):
+        median_xyz[:, axis] = _segment_medians(points[:, axis], labels, starts, counts)
+    median_range_mm = _segment_medians(range_mm.ravel()[pixels].astype(np.float64), labels, starts, counts)
+    if ids.shape[0] > 0:
+        mean_xyz = np.add.reduceat(points, starts, axis=0) / counts[:, np.newaxis]
+    else:
+        mean_xyz = np.empty((0, 3), np.float64)
+
+    # Point of each instance closest to its median: the first one of its run once sorted by (label, distance)
+    dists = np.linalg.norm(points - median_xyz[inverse], axis=-1)
+    closest = pixels[np.lexsort((dists, labels))[starts]]
+    closest_pixel = np.stack(np.unravel_index(closest, instance_id_img.shape), axis=-1)
+
+    return InstanceStats(ids, counts, median_xyz, mean_xyz, median_range_mm, closest_pixel)
@@ -0,0 +1,220 @@
+"""
+Process metrics in the Prometheus text format, served over HTTP by serve_metrics() and summarised as a JSON-able
+dict by Metrics.snapshot() for the websocket "stats" message.
+
+Counters and histograms are updated by the pipeline threads; values owned by other objects (queue depths,
+connected clients, ...) are read through callbacks when the metrics are collected, so they cost nothing in between.
+"""
+import asyncio
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        # (suffix, label names, label values, value) of every sample
+        with self._lock:
+            return [("", self.labelnames, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """
+    A gauge either set explicitly or read from fn() on collection. fn returns a number, or a dict mapping the
+    value of the single label to a number.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        super().__init__(name, help, labelnames)
+        self._fn = fn
+
+    def set(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def collect(self):
+        if self._fn is None:
+            return super().collect()
+        value = self._fn()
+        if isinstance(value, dict):
+            return [("", self.labelnames, (str(label),), v) for label, v in value.items()]
+        return [("", (), (), value)]
+
+
+class CallbackCounter(Gauge):
+    # A counter owned by another object (e.g. the frames dropped by the BroadcastHub), read from fn()
+    kind = "counter"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def collect(self):
+        samples = []
+        names = self.labelnames + ("le",)
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values[:-1]):
+                cumulative += count
+                samples.append(("_bucket", names, key + (str(bound),), cumulative))
+            samples.append(("_count", self.labelnames, key, cumulative))
+            samples.append(("_sum", self.labelnames, key, values[-1]))
+        return samples
+
+    @staticmethod
+    def _quantile(buckets, counts, q):
+        # Upper bound of the bucket holding the q quantile, as histogram_quantile() without interpolation.
+        # None beyond the last finite bucket
+        rank = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(buckets, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return None
+
+    def summary(self):
+        # {label values joined by ",": {"count", "mean_ms", "p50_ms", "p95_ms"}}
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        summary = {}
+        for key, values in series.items():
+            count = sum(values[:-1])
+            p50, p95 = (self._quantile(self.buckets, values[:-1], q) for q in (0.5, 0.95))
+            summary[",".join(key) or "all"] = {
+                "count": count,
+                "mean_ms": values[-1] / count * 1000,
+                "p50_ms": p50 * 1000 if p50 is not None else None,
+                "p95_ms": p95 * 1000 if p95 is not None else None,
+            }
+        return summary
+
+
+class Metrics:
+    """
+    Registry of the metrics of the process, all named with the given prefix.
+    """
+
+    def __init__(self, prefix="railways"):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _add(self, metric):
+        metric.name = f"{self.prefix}_{metric.name}"
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=(), fn=None):
+        if fn is not None:
+            return self._add(CallbackCounter(name, help, labelnames, fn))
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), fn=None):
+        return self._add(Gauge(name, help, labelnames, fn))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, names, values, value in metric.collect():
+                lines.append(f"{metric.name}{suffix}{_labels(names, values)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Current values as a dict: numbers for unlabelled counters and gauges, {label: number} for labelled ones and
+        {label: {"count", "mean_ms", "p50_ms", "p95_ms"}} for histograms.
+        """
+        data = {}
+        for metric in self._metrics:
+            name = metric.name[len(self.prefix) + 1:]
+            if isinstance(metric, Histogram):
+                data[name] = metric.summary()
+                continue
+            samples = metric.collect()
+            if samples and not samples[0][1]:
+                data[name] = samples[0][3]
+            else:
+                data[name] = {",".join(values): value for _, _, values, value in samples}
+        return data
+
+
+async def serve_metrics(metrics, host="localhost", port=9100):
+    """
+    Serves metrics.render() on GET /metrics. Returns the asyncio server, to be closed by the caller.
+    """
+
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            # Skip the headers, the request has no body
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", metrics.render().encode()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                status, body, content_type = "404 Not Found", b"not found\n", "text/plain"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info("Metriche Prometheus su http://%s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,128 @@
+"""
+Headless websocket client for load tests: opens N concurrent connections to mockServer.py (or server.py) and
+reports the throughput, the per-message and per-frame latency and the frames lost by every client.
+
+    python mockClient.py ws://localhost:8000 --clients 8 --duration 30
+    python mockClient.py ws://localhost:8000 --clients 50 --subscribe '{"topics": ["detections"], "max_rate": 2}'
+
+Latencies need the "time" of the "frame" messages, which only mockServer.py sends: a message belongs to the
+frame whose "frame" message follows it (the messages of a frame are sent in order, "frame" last), and its latency
+is its arrival time minus the time the frame was published. Server and client must share the clock, i.e. run on
+the same host or on NTP synchronized ones. Against server.py only the throughput and the lost frames are reported.
+
+Lost frames are the gaps in the frame counters of every sensor: frames dropped by the server because the client
+was too slow, plus the ones skipped on purpose by a subscription with max_rate.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+import websockets
+
+from benchmark import latency_summary
+from topics import topic_of
+
+
+class ClientStats:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.frames = 0
+        self.lost = 0  # gaps in the frame counters
+        self.message_latencies = []  # seconds
+        self.frame_latencies = []  # arrival of the "frame" message, i.e. of the whole frame
+        self._last_frame = {}  # sensor -> last frame counter
+        self._pending = []  # arrival times of the messages of the frame being received
+
+    def on_message(self, message, now):
+        self.messages += 1
+        self.bytes += len(message)
+        topic = topic_of(message)
+        if topic == "frame":
+            self.on_frame(json.loads(message), now)
+        elif topic != "stats":
+            self._pending.append(now)
+
+    def on_frame(self, frame, now):
+        self.frames += 1
+        sensor = frame.get("sensor", 0)
+        last = self._last_frame.get(sensor)
+        if last is not None and frame["frame"] > last + 1:
+            self.lost += frame["frame"] - last - 1
+        self._last_frame[sensor] = frame["frame"]
+        if "time" in frame:
+            self.message_latencies += [arrival - frame["time"] for arrival in self._pending]
+            self.message_latencies.append(now - frame["time"])
+            self.frame_latencies.append(now - frame["time"])
+        self._pending.clear()
+
+
+async def run_client(url, stats, duration, subscription=None):
+    async with websockets.connect(url, max_size=None) as websocket:
+        if subscription is not None:
+            await websocket.send(json.dumps({"type": "subscribe", **subscription}))
+        end = time.monotonic() + duration
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.recv(), timeout=max(end - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                return
+            stats.on_message(message, time.time())
+
+
+def report(clients, elapsed):
+    frames = sum(c.frames for c in clients)
+    lost = sum(c.lost for c in clients)
+    message_latencies = [s for c in clients for s in c.message_latencies]
+    frame_latencies = [s for c in clients for s in c.frame_latencies]
+    return {
+        "clients": len(clients),
+        "seconds": elapsed,
+        "messages_per_s": sum(c.messages for c in clients) / elapsed,
+        "mb_per_s": sum(c.bytes for c in clients) / elapsed / 2**20,
+        "frames_per_s_per_client": frames / elapsed / len(clients),
+        "frames_per_s_slowest_client": min(c.frames for c in clients) / elapsed,
+        "frames_lost": lost,
+        "frames_lost_ratio": lost / (frames + lost) if frames + lost else 0.0,
+        "message_latency": latency_summary(message_latencies) if message_latencies else {},
+        "frame_latency": latency_summary(frame_latencies) if frame_latencies else {},
+        "frame_latency_max_ms": float(np.max(frame_latencies) * 1000) if frame_latencies else None,
+    }
+
+
+async def main(args):
+    subscription = json.loads(args.subscribe) if args.subscribe else None
+    clients = [ClientStats() for _ in range(args.clients)]
+    start = time.monotonic()
+    results = await asyncio.gather(*(run_client(args.url, stats, args.duration, subscription) for stats in clients),
+                                   return_exceptions=True)
+    elapsed = time.monotonic() - start
+    failed = [r for r in results if isinstance(r, BaseException)]
+    for error in failed[:3]:
+        print(f"Connessione fallita: {error!r}")
+    connected = [stats for stats, r in zip(clients, results) if not isinstance(r, BaseException)]
+    if not connected:
+        raise SystemExit("Nessun client connesso")
+    result = report(connected, elapsed)
+    result["clients_failed"] = len(failed)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='mockClient', description='Websocket load test client')
+    parser.add_argument('url', type=str, nargs='?', default='ws://localhost:8000')
+    parser.add_argument('--clients', type=int, default=1, help='Concurrent websocket connections')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of measurement')
+    parser.add_argument('--subscribe', type=str, default=None,
+                        help='JSON subscription sent by every client, e.g. \'{"topics": ["detections"]}\'')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON report to this file')
+    args = parser.parse_args()
+
+    result = asyncio.run(main(args))
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
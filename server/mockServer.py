@@ -1,93 +1,195 @@
+"""
+Mock websocket server producing frames as large as the real ones, without a sensor or a model. Used to size the
+hardware and the network, and to regression-test the streaming path and the frontend with mockClient.py.
+
+    python mockServer.py --points 262144 --image-size 2048 128 --detections 20 --fps 10 --format binary
+    python mockServer.py --format json --points 20000 --image-codec png
+
+Every frame has the messages of server.py, in the same order (point, detections, image1, image2, frame) and in
+the same encodings (binary wire.py messages or the legacy JSON ones). The "frame" message also carries "time", the
+wall clock at which the frame was published, from which mockClient.py measures the latency. Clients can pause and
+subscribe to topics (see topics.py) like with the real server.
+
+The frames are generated once, before serving: the fps measured by the clients is bounded by the network and the
+clients only. Every published frame carries the running frame counter, in the "frame" message and in the header
+of the binary messages, so the clients can count the frames lost.
+"""
+import argparse
 import asyncio
-import websockets
-import json
 import base64
-import random
-from PIL import Image
-import io
+import json
+import logging
+import time
 
-FRAME_INTERVAL = 0.1  # seconds
+import cv2
+import numpy as np
+import websockets
 
-async def send_mock_data(websocket):
+import wire
+from hub import BroadcastHub
+from image_codec import CODECS, ImageEncoder
+from topics import Subscription
+
+logger = logging.getLogger(__name__)
+
+# Frames generated up front and sent in a loop
+DISTINCT_FRAMES = 8
+
+
+def synthetic_cloud(count, rng, beams=128):
+    """
+    (count, 3) float32 points of a lidar-like scene: beams from -22.5° to 22.5° of elevation over the whole
+    azimuth, hitting a ground plane 2 m below the sensor or a wall at 5-40 m.
+    """
+    columns = max(count // beams, 1)
+    elevation = np.deg2rad(np.linspace(-22.5, 22.5, beams))[:, np.newaxis]
+    azimuth = np.linspace(-np.pi, np.pi, columns, endpoint=False)[np.newaxis, :]
+    wall = 5 + 35 * (0.5 + 0.5 * np.sin(3 * azimuth)) + rng.normal(0, 0.02, (beams, columns))
+    ground = np.where(elevation < 0, 2 / np.maximum(np.tan(-elevation), 1e-3), np.inf)
+    distance = np.minimum(wall, ground)
+    xyz = np.stack([distance * np.cos(azimuth), distance * np.sin(azimuth),
+                    distance * np.tan(elevation) * np.ones_like(azimuth)], axis=-1)
+    return xyz.reshape(-1, 3)[:count].astype(np.float32)
+
+
+def synthetic_image(width, height, rng):
+    # Smooth structure plus sensor noise, so that the images compress about as well as the real ones
+    coarse = rng.integers(0, 256, (max(height // 8, 1), max(width // 8, 1)), dtype=np.uint8)
+    img = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC).astype(np.int16)
+    img += rng.integers(-12, 13, (height, width), dtype=np.int16)
+    return np.repeat(np.clip(img, 0, 255).astype(np.uint8)[..., np.newaxis], 3, axis=-1)
+
+
+def synthetic_detections(count, rng):
+    return [{
+        "id": int(k + 1),
+        "position": {"x": float(x), "y": float(y), "z": float(z)},
+        "velocity": {"vx": float(vx), "vy": float(vy), "vz": float(vz)},
+    } for k, (x, y, z, vx, vy, vz) in enumerate(
+        np.concatenate([rng.uniform(-6, 6, (count, 3)), rng.uniform(-3, 3, (count, 3))], axis=1))]
+
+
+def make_frames(args):
+    """
+    Returns DISTINCT_FRAMES frames, each one the list of its messages without the "frame" message, which is built
+    when the frame is published.
+    """
+    rng = np.random.default_rng(args.seed)
+    encoder = ImageEncoder(args.image_codec, args.image_quality, workers=2)
+    width, height = args.image_size
+    frames = []
+    for k in range(DISTINCT_FRAMES):
+        xyz = synthetic_cloud(args.points, rng)
+        images = [encoder.submit(synthetic_image(width, height, rng)) for _ in range(2)]
+        detections = json.dumps({"type": "detections", "data": synthetic_detections(args.detections, rng)})
+        if args.format == "binary":
+            # Frame counter 0 in the headers, restamped with the running one when published
+            points = wire.encode_points(xyz, 0, reflectivity=rng.random(len(xyz), np.float32))
+            image_messages = [wire.encode_image(image.result(), slot, encoder.codec, 0)
+                              for image, slot in zip(images, (wire.IMAGE_RESULTS, wire.IMAGE_INSTANCES))]
+        else:
+            points = json.dumps({"type": "point", "data": [{"x": x, "y": y, "z": z} for x, y, z in xyz.tolist()]})
+            image_messages = [json.dumps({"type": kind, "data": base64.b64encode(image.result()).decode()})
+                              for image, kind in zip(images, ("image1", "image2"))]
+        frames.append([points, detections] + image_messages)
+    encoder.shutdown()
+    return frames
+
+
+async def publish_frames(hub, frames, fps, count):
+    # Paced on the ideal schedule, so that a slow send does not lower the rate of the following frames
+    start = time.monotonic()
     frame = 0
-    paused = False
+    while count == 0 or frame < count:
+        due = start + frame / fps
+        await asyncio.sleep(max(due - time.monotonic(), 0))
+        # Copies with the running counter: the queues of the clients may still hold the previous ones
+        messages = [message if isinstance(message, str) else wire.restamp(message, frame)
+                    for message in frames[frame % len(frames)]]
+        messages.append(json.dumps({"type": "frame", "frame": frame, "time": time.time()}))
+        if hub.subscribers:
+            hub.publish(messages)
+        frame += 1
 
-    async def receive_commands():
-        nonlocal paused
-        async for message in websocket:
-            if message == "toggle_pause":
-                paused = not paused
-                print(f"Paused: {paused}")
-
-    asyncio.create_task(receive_commands())
-
-    while True:
-        if paused:
-            await asyncio.sleep(0.1)
-            continue  # Salta invio dati se in pausa
-
-        # --- Solo se NON in pausa fa questo ---
-        # Crea immagine
-        img = Image.new('RGB', (100, 50), (random.randint(0,255), random.randint(0,255), random.randint(0,255)))
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-        # Crea punti
-        points = [{"x": random.uniform(-5, 5), "y": random.uniform(-5, 5), "z": random.uniform(-5, 5)} for _ in range(10)]
-
-        # Crea detections
-        num_detections = random.randint(0, 5)
-        detections = []
-        for _ in range(num_detections):
-            detection = {
-                "position": {
-                    "x": random.uniform(-6, 6),
-                    "y": random.uniform(-6, 6),
-                    "z": random.uniform(-6, 6)
-                },
-                "velocity": {
-                    "vx": random.uniform(-3,3),
-                    "vy": random.uniform(-3,3),
-                    "vz": random.uniform(-3,3)
-                }
-            }
-            detections.append(detection)
- 
-        # Invia i dati
-        await websocket.send(json.dumps({
-            "type": "point",
-            "data": points
-        }))
-
-        await websocket.send(json.dumps({
-            "type": "detections",
-            "data": detections
-        }))
-
-        await websocket.send(json.dumps({
-            "type": "image1",
-            "data": img_base64
-        }))
-
-        await websocket.send(json.dumps({
-            "type": "image2",
-            "data": img_base64
-        }))
-
-        await websocket.send(json.dumps({
-            "type": "frame",
-            "frame": frame
-        }))
 
-        frame += 1
+async def mock_handler(websocket, hub):
+    subscriber = hub.subscribe(websocket)
+    logger.info("Client connesso, %d in totale", len(hub.subscribers))
 
-        await asyncio.sleep(FRAME_INTERVAL)
+    async def send_frames():
+        try:
+            await subscriber.run()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def receive_commands():
+        try:
+            async for message in websocket:
+                if message == "toggle_pause":
+                    subscriber.paused = not subscriber.paused
+                    hub.update_demand()
+                    logger.info("Paused: %s", subscriber.paused)
+                    continue
+                try:
+                    command = json.loads(message)
+                except (TypeError, ValueError):
+                    continue
+                if isinstance(command, dict) and command.get("type") == "subscribe":
+                    try:
+                        subscriber.subscription = Subscription.from_command(command)
+                    except (TypeError, ValueError) as e:
+                        await websocket.send(json.dumps({"type": "error", "message": str(e)}))
+                        continue
+                    hub.update_demand()
+                    await websocket.send(subscriber.subscription.to_message())
+                # request_keyframe: the mock frames have no static background, nothing to send
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    tasks = [asyncio.create_task(send_frames()), asyncio.create_task(receive_commands())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Retrieve the outcome of both tasks, so that no exception is left unretrieved
+        await asyncio.gather(*tasks, return_exceptions=True)
+        hub.unsubscribe(subscriber)
+        logger.info("Client disconnesso: frame inviati %d, scartati %d", subscriber.sent, subscriber.dropped)
+
+
+async def main(args):
+    start = time.perf_counter()
+    frames = make_frames(args)
+    frame_bytes = sum(len(message) for message in frames[0])
+    logger.warning("%d frame generati in %.1f s, %.2f MB per frame (%.1f MB/s per client a %g fps)",
+                   len(frames), time.perf_counter() - start, frame_bytes / 2**20, frame_bytes * args.fps / 2**20,
+                   args.fps)
+
+    hub = BroadcastHub(max_queue=args.client_queue)
+    async with websockets.serve(lambda ws: mock_handler(ws, hub), args.host, args.port, max_size=None):
+        logger.warning("Mock WebSocket server running at ws://%s:%d/", args.host, args.port)
+        await publish_frames(hub, frames, args.fps, args.frames)
 
-async def main():
-    async with websockets.serve(send_mock_data, "localhost", 8000):
-        print("Mock WebSocket server running at ws://localhost:8000/")
-        await asyncio.Future()  # run forever
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(prog='mockServer', description='Streams synthetic frames of production size')
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--format', choices=['binary', 'json'], default='binary',
+                        help='Encoding of the point and image messages, as server.py --point-format')
+    parser.add_argument('--points', type=int, default=128 * 2048, help='Points per frame (128x2048 = full scan)')
+    parser.add_argument('--image-size', type=int, nargs=2, default=[2048, 128], metavar=('WIDTH', 'HEIGHT'),
+                        help='Size of the two images of every frame')
+    parser.add_argument('--image-codec', choices=list(CODECS), default='jpeg')
+    parser.add_argument('--image-quality', type=int, default=85)
+    parser.add_argument('--detections', type=int, default=5, help='Detections per frame')
+    parser.add_argument('--fps', type=float, default=10, help='Frames per second')
+    parser.add_argument('--frames', type=int, default=0, help='Stop after this many frames (0 = never)')
+    parser.add_argument('--client-queue', type=int, default=2,
+                        help='Frames buffered per client before the oldest ones are dropped')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='WARNING')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    asyncio.run(main(args))
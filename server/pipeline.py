@@ -0,0 +1,106 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+_END = object()  # Marks the end of the source
+
+
+class StagedPipeline:
+    """
+    Runs a chain of stages in worker threads connected by bounded queues, so that different stages work on
+    different frames at the same time (e.g. preprocessing of frame N+1 while frame N is in inference).
+
+    The first stage runs in the thread that reads the source. A stage returning None drops the item. Heavy work
+    (NumPy, OpenCV, PyTorch) releases the GIL, so threads are enough to overlap the stages while keeping the
+    models and the tracker state in a single process.
+
+    stop() also closes the source, if it has a close() method.
+    """
+
+    def __init__(self, source, stages, queue_size=1):
+        self._source = source
+        self._stages = stages  # list of (name, function)
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._stop = threading.Event()
+        self._threads = []
+        self.errors = {name: 0 for name, _ in stages}  # items dropped because the stage raised
+        self.dropped = {name: 0 for name, _ in stages}  # items the stage returned None for
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._read_source, name=self._stages[0][0], daemon=True)]
+        for i in range(1, len(self._stages)):
+            self._threads.append(threading.Thread(target=self._work, args=(i,), name=self._stages[i][0], daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+        close = getattr(self._source, "close", None)
+        if close is not None:
+            # Also unblocks a reader still waiting for the next item of the source
+            close()
+            self._threads[0].join(timeout=1.0)
+
+    def get(self):
+        """
+        Blocks until the next finished item is available. Returns None when the source is exhausted or the
+        pipeline has been stopped.
+        """
+        while not self._stop.is_set():
+            try:
+                item = self._queues[-1].get(timeout=0.1)
+            except queue.Empty:
+                continue
+            return None if item is _END else item
+        return None
+
+    def queue_sizes(self):
+        return {name: q.qsize() for (name, _), q in zip(self._stages, self._queues)}
+
+    def _put(self, i, item):
+        # Retry so that a full queue does not prevent the thread from noticing stop()
+        while not self._stop.is_set():
+            try:
+                self._queues[i].put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _run_stage(self, i, item):
+        name, function = self._stages[i]
+        try:
+            item = function(item)
+        except Exception:
+            logger.exception("Errore nello stage %s", name)
+            self.errors[name] += 1
+            return None
+        if item is None:
+            self.dropped[name] += 1
+        return item
+
+    def _read_source(self):
+        for item in self._source:
+            if self._stop.is_set():
+                return
+            item = self._run_stage(0, item)
+            if item is not None:
+                self._put(0, item)
+        self._put(0, _END)
+
+    def _work(self, i):
+        while not self._stop.is_set():
+            try:
+                item = self._queues[i - 1].get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is not _END:
+                item = self._run_stage(i, item)
+                if item is None:
+                    continue
+            self._put(i, item)
+            if item is _END:
+                return
@@ -0,0 +1,98 @@
+import json
+
+import numpy as np
+
+
+def load_polygon(path):
+    """
+    Reads a crop polygon from a JSON file containing a list of [x, y] vertices in meters, sensor frame.
+    """
+    with open(path) as f:
+        polygon = np.asarray(json.load(f), np.float64)
+    if polygon.ndim != 2 or polygon.shape[1] != 2 or polygon.shape[0] < 3:
+        raise ValueError(f"{path}: il poligono deve essere una lista di almeno 3 vertici [x, y]")
+    return polygon
+
+
+def points_in_polygon(xy, polygon):
+    # Even-odd ray casting, vectorized over the points (one pass per polygon edge)
+    inside = np.zeros(xy.shape[0], bool)
+    x, y = xy[:, 0], xy[:, 1]
+    for (x0, y0), (x1, y1) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+
+class PointFilter:
+    """
+    Thins the streamed point cloud before encoding. select() returns the indices of the points to keep, so any
+    per-point channel can follow the xyz selection. Foreground points (detected instances) are never thinned,
+    only cropped; background points go through range decimation, a voxel grid and finally the point budget.
+
+    crop_box: (xmin, ymin, zmin, xmax, ymax, zmax) in meters, or None
+    crop_polygon: (K, 2) xy polygon in meters (e.g. the track corridor), or None
+    voxel_size: edge of the voxel grid in meters, 0 disables it
+    decimate_range: background points closer than this (meters) are kept with probability (range / decimate_range)^2,
+        which evens out the point density of the near field. 0 disables it
+    point_budget: maximum number of points per frame, 0 means unlimited
+    """
+
+    def __init__(self, crop_box=None, crop_polygon=None, voxel_size=0.0, decimate_range=0.0, point_budget=0):
+        self.crop_box = None if crop_box is None else np.asarray(crop_box, np.float64).reshape(2, 3)
+        self.crop_polygon = crop_polygon
+        self.voxel_size = voxel_size
+        self.decimate_range = decimate_range
+        self.point_budget = point_budget
+        self._pixel_thresholds = None
+
+    @property
+    def enabled(self):
+        return (self.crop_box is not None or self.crop_polygon is not None or self.voxel_size > 0
+                or self.decimate_range > 0 or self.point_budget > 0)
+
+    def _thresholds(self, pixels, image_size):
+        # A fixed random threshold per image pixel, so that decimation keeps the same pixels from frame to frame
+        # instead of flickering
+        if self._pixel_thresholds is None or self._pixel_thresholds.shape[0] != image_size:
+            self._pixel_thresholds = np.random.default_rng(0).random(image_size, np.float32)
+        return self._pixel_thresholds[pixels]
+
+    def select(self, xyz, range_mm, foreground, pixels, image_size, point_budget=None):
+        """
+        xyz: (N, 3) points, range_mm: (N,) their range, foreground: (N,) bool, pixels: (N,) flat image index of
+        every point, image_size: number of pixels of the image. point_budget overrides the configured budget.
+        Returns the sorted indices of the points to keep.
+        """
+        point_budget = self.point_budget if point_budget is None else point_budget
+        keep = np.ones(xyz.shape[0], bool)
+        if self.crop_box is not None:
+            keep &= np.all((xyz >= self.crop_box[0]) & (xyz <= self.crop_box[1]), axis=1)
+        if self.crop_polygon is not None:
+            keep &= points_in_polygon(xyz[:, :2], self.crop_polygon)
+
+        foreground_idx = np.flatnonzero(keep & foreground)
+        keep &= ~foreground
+        if self.decimate_range > 0:
+            probability = np.square(range_mm * (0.001 / self.decimate_range))
+            keep &= self._thresholds(pixels, image_size) < probability
+        background_idx = np.flatnonzero(keep)
+
+        if self.voxel_size > 0 and background_idx.size > 0:
+            # One point per occupied voxel: the first one in image order
+            voxels = np.floor(xyz[background_idx] / self.voxel_size).astype(np.int64)
+            voxels -= voxels.min(axis=0)
+            extent = voxels.max(axis=0) + 1
+            keys = (voxels[:, 0] * extent[1] + voxels[:, 1]) * extent[2] + voxels[:, 2]
+            _, first = np.unique(keys, return_index=True)
+            background_idx = background_idx[np.sort(first)]
+
+        if point_budget > 0:
+            room = max(point_budget - foreground_idx.size, 0)
+            if background_idx.size > room:
+                # Evenly spaced subset, the foreground is always kept even beyond the budget
+                background_idx = background_idx[np.linspace(0, background_idx.size, room, endpoint=False).astype(np.int64)]
+
+        return np.sort(np.concatenate([foreground_idx, background_idx]))
@@ -0,0 +1,234 @@
+"""
+Recording of the processed output of server.py and its replay without the processing pipeline.
+
+A recording is made of two append-only files:
+
+    <path>      data: an 8 byte magic followed by the websocket messages of every frame, each one as
+                    type  uint8   MESSAGE_TEXT (JSON str) or MESSAGE_BINARY (wire.py message)
+                    size  uint32  payload size in bytes
+                    payload
+    <path>.idx  index: one INDEX_DTYPE entry per frame (frame counter, wall clock and scan time, offset and size
+                of the frame in the data file, flags)
+
+Recording again to the same path appends a new session, whose frame counters start over: frame numbers are only
+unique within a session (see Player.sessions).
+
+Frames are exactly the message lists published to the websocket clients, so a replay is indistinguishable from
+the live stream. The Player memory-maps the data file, so seeking costs nothing and only the frames sent are read.
+"""
+import asyncio
+import bisect
+import logging
+import mmap
+import struct
+import time
+
+import numpy as np
+
+import wire
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"RWREC\x00\x01\x00"
+MESSAGE = struct.Struct("<BI")
+MESSAGE_TEXT = 0
+MESSAGE_BINARY = 1
+
+FRAME_KEYFRAME = 0x01  # the frame holds a static background keyframe (wire.LAYER_STATIC)
+FRAME_SESSION = 0x02  # first frame written by a Recorder, the frame counters may start over
+# Keyframe frames looked back at to find the keyframe of every sensor of a multi-sensor recording
+KEYFRAME_LOOKBACK = 64
+
+INDEX_DTYPE = np.dtype([
+    ("frame", "<u8"),  # ScanFrame.frame_count
+    ("time", "<f8"),  # wall clock when the frame was recorded, unix seconds
+    ("scan_time", "<f8"),  # ScanFrame.timestamp
+    ("offset", "<u8"),
+    ("size", "<u4"),
+    ("flags", "<u4"),
+])
+
+
+class Recorder:
+    """
+    Appends frames to a recording, creating it if needed. write() is called from the pipeline thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._data = open(path, "ab")
+        if self._data.tell() == 0:
+            self._data.write(MAGIC)
+        self._index = open(path + ".idx", "ab")
+        self.frames = 0
+
+    def write(self, frame, messages, scan_time=0.0):
+        offset = self._data.tell()
+        flags = 0
+        for message in messages:
+            if isinstance(message, str):
+                payload, kind = message.encode(), MESSAGE_TEXT
+            else:
+                payload, kind = message, MESSAGE_BINARY
+                if wire.is_keyframe(message):
+                    flags |= FRAME_KEYFRAME
+            self._data.write(MESSAGE.pack(kind, len(payload)))
+            self._data.write(payload)
+        if self.frames == 0:
+            flags |= FRAME_SESSION
+        entry = np.array([(frame, time.time(), scan_time, offset, self._data.tell() - offset, flags)], INDEX_DTYPE)
+        # The data goes to disk before its index entry, so the index never points past the data
+        self._data.flush()
+        self._index.write(entry.tobytes())
+        self._index.flush()
+        self.frames += 1
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+
+class Player:
+    """
+    Random access to the frames of a recording through a read-only memory map of the data file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path}: non è una registrazione")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index = np.fromfile(path + ".idx", INDEX_DTYPE)
+        # Drop the entries of a frame that was being written when the recording stopped
+        self.index = index[index["offset"] + index["size"] <= len(self._mmap)]
+        if len(self.index) == 0:
+            raise ValueError(f"{path}: la registrazione è vuota")
+        self._keyframes = np.flatnonzero(self.index["flags"] & FRAME_KEYFRAME)
+        # Start positions of the sessions appended to the file. Recordings without FRAME_SESSION flags are split
+        # where the frame counter goes back
+        counters = self.index["frame"]
+        starts = (self.index["flags"] & FRAME_SESSION) != 0
+        starts[1:] |= counters[1:] <= counters[:-1]
+        starts[0] = True
+        self.sessions = np.flatnonzero(starts)
+        logger.info("Registrazione %s: %d frame, %d keyframe, %d sessioni", path, len(self.index),
+                    len(self._keyframes), len(self.sessions))
+
+    def __len__(self):
+        return len(self.index)
+
+    def messages(self, i):
+        """
+        Returns the websocket messages of the i-th frame: str for JSON, memoryview for binary messages.
+        """
+        view = memoryview(self._mmap)
+        offset = int(self.index["offset"][i])
+        end = offset + int(self.index["size"][i])
+        messages = []
+        while offset < end:
+            kind, size = MESSAGE.unpack_from(self._mmap, offset)
+            offset += MESSAGE.size
+            payload = view[offset:offset + size]
+            messages.append(str(payload, "utf-8") if kind == MESSAGE_TEXT else payload)
+            offset += size
+        return messages
+
+    def keyframes(self, i):
+        # The static background keyframes in effect at the i-th frame, one per sensor (wire header byte 2)
+        k = bisect.bisect_right(self._keyframes, i)
+        found = {}
+        for j in self._keyframes[max(k - KEYFRAME_LOOKBACK, 0):k][::-1]:
+            for message in self.messages(j):
+                if wire.is_keyframe(message):
+                    found.setdefault(message[2], message)
+        return [found[sensor] for sensor in sorted(found)]
+
+    def find_frame(self, frame, session=-1):
+        # Position of the first frame with a counter >= frame in a session (the last one by default), where the
+        # counters are increasing
+        start = int(self.sessions[session])
+        end = int(self.sessions[session + 1]) if session + 1 not in (0, len(self.sessions)) else len(self)
+        return min(start + int(np.searchsorted(self.index["frame"][start:end], frame)), end - 1)
+
+    def find_time(self, unix_time):
+        # Position of the first frame recorded at or after unix_time
+        return min(int(np.searchsorted(self.index["time"], unix_time)), len(self) - 1)
+
+
+class Replay:
+    """
+    Publishes the frames of a recording to a BroadcastHub at the recorded pace times speed. Seeking and speed
+    changes take effect on the next frame. Exposes keyframes() and request_keyframe() like ScanIterator, so the
+    websocket handler serves both the same way.
+    """
+
+    def __init__(self, player, speed=1.0, loop=False):
+        self.player = player
+        self.speed = speed
+        self.loop = loop
+        self._keyframes = {}  # sensor -> last static keyframe message
+        self._position = 0
+        self._moved = asyncio.Event()  # set on seek or speed change, to restart the pacing
+
+    def keyframes(self):
+        return [self._keyframes[sensor] for sensor in sorted(self._keyframes)]
+
+    def request_keyframe(self):
+        # Every frame of a recording can be sent at any time, the cached keyframes are always up to date
+        pass
+
+    def seek(self, frame=None, unix_time=None, session=-1):
+        if frame is not None:
+            self._position = self.player.find_frame(frame, session)
+        elif unix_time is not None:
+            self._position = self.player.find_time(unix_time)
+        self._moved.set()
+
+    def set_speed(self, speed):
+        if speed > 0:
+            self.speed = speed
+            self._moved.set()
+
+    async def run(self, hub):
+        times = self.player.index["time"]
+        anchor = None  # (position, monotonic time) the pacing is computed from
+        while True:
+            if self._position >= len(self.player):
+                if not self.loop:
+                    return
+                self._position = 0
+                anchor = None
+            i = self._position
+            if anchor is None or self._moved.is_set() or times[i] < times[anchor[0]]:
+                self._moved.clear()
+                anchor = (i, time.monotonic())
+                # After a jump the clients need the static background of the new position
+                keyframes = self.player.keyframes(i)
+                self._keyframes = {keyframe[2]: keyframe for keyframe in keyframes}
+                if keyframes:
+                    hub.publish(keyframes)
+
+            messages = self.player.messages(i)
+            for message in messages:
+                if wire.is_keyframe(message):
+                    self._keyframes[message[2]] = message
+            hub.publish(messages)
+            self._position = i + 1
+
+            if self._position < len(self.player):
+                due = anchor[1] + (times[self._position] - times[anchor[0]]) / self.speed
+                try:
+                    await asyncio.wait_for(self._moved.wait(), timeout=max(due - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    pass
+
+
+def parse_time(value):
+    # Unix seconds or an ISO 8601 date and time (local time if no offset is given)
+    try:
+        return float(value)
+    except ValueError:
+        from datetime import datetime
+        return datetime.fromisoformat(value).timestamp()
+
@@ -0,0 +1,158 @@
+"""
+Caches of the encoded websocket messages of a scan, for sources replayed in a loop (open_source(..., cycle=True)):
+from the second lap on every scan is served from the cache and skips the whole processing.
+
+Keys identify a scan within its source (frame_id and first column timestamp); the namespace given to the cache
+identifies the source and the processing options, so a different recording or configuration never hits stale
+results. Both caches evict the least recently used entries beyond max_bytes.
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from recording import MESSAGE, MESSAGE_BINARY, MESSAGE_TEXT
+
+logger = logging.getLogger(__name__)
+
+
+def source_namespace(source, options):
+    """
+    Namespace of a cache: the path, size and modification time of the source file plus the options that change
+    the results. Returns None for sources that are not files (a live sensor never repeats a scan).
+    """
+    if not os.path.isfile(source):
+        return None
+    stat = os.stat(source)
+    identity = repr((os.path.abspath(source), stat.st_size, stat.st_mtime_ns, sorted(options.items())))
+    return hashlib.sha1(identity.encode()).hexdigest()[:16]
+
+
+def _size(messages):
+    return sum(len(message) for message in messages)
+
+
+class MemoryResultCache:
+    def __init__(self, namespace, max_bytes=512 * 2**20):
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> messages, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            messages = self._entries.get(key)
+            if messages is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return messages
+
+    def put(self, key, messages):
+        size = _size(messages)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size_bytes -= _size(previous)
+            self._entries[key] = messages
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= _size(evicted)
+
+
+class DiskResultCache:
+    """
+    One file per scan under directory/namespace, with the messages framed as in a recording. Survives restarts:
+    the files already there are picked up, in modification time order, as the initial LRU order.
+    """
+
+    def __init__(self, directory, namespace, max_bytes=4 * 2**30):
+        self.directory = os.path.join(directory, namespace)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # file name -> size, least recently used first
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".bin")]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            self._entries[entry.name] = entry.stat().st_size
+        self.size_bytes = sum(self._entries.values())
+        logger.info("Cache dei risultati %s: %d scansioni, %.1f MB", self.directory, len(self._entries),
+                    self.size_bytes / 2**20)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _name(key):
+        return "_".join(str(part) for part in key) + ".bin"
+
+    def get(self, key):
+        name = self._name(key)
+        with self._lock:
+            if name not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+                self._entries.pop(name, None)
+            return None
+        messages = []
+        offset = 0
+        while offset < len(data):
+            kind, size = MESSAGE.unpack_from(data, offset)
+            offset += MESSAGE.size
+            payload = data[offset:offset + size]
+            messages.append(payload.decode() if kind == MESSAGE_TEXT else payload)
+            offset += size
+        with self._lock:
+            self.hits += 1
+        return messages
+
+    def put(self, key, messages):
+        name = self._name(key)
+        chunks = []
+        for message in messages:
+            if isinstance(message, str):
+                payload, kind = message.encode(), MESSAGE_TEXT
+            else:
+                payload, kind = message, MESSAGE_BINARY
+            chunks += [MESSAGE.pack(kind, len(payload)), payload]
+        data = b"".join(chunks)
+        if len(data) > self.max_bytes:
+            return
+        path = os.path.join(self.directory, name)
+        # Written aside and renamed, so a reader never sees a partial file
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            self.size_bytes += len(data) - self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+            evicted = []
+            while self.size_bytes > self.max_bytes:
+                old, size = self._entries.popitem(last=False)
+                self.size_bytes -= size
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
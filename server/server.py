@@ -1,25 +1,148 @@
 import argparse
+import logging
 from functools import partial
 
 import asyncio
+import itertools
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import copy
 import websockets
 import json
-import base64
-import random
-from PIL import Image
-import io
 import numpy as np
 import cv2
 from ultralytics import YOLO
 from ultralytics.engine.results import Results
+from ultralytics.trackers.track import TRACKER_MAP
+from ultralytics.utils import IterableSimpleNamespace
+from ultralytics.utils.checks import check_yaml
+import yaml
 import torch
-import matplotlib.pyplot as plt
 import matplotlib as mpl
 from matplotlib import cm
-from ouster.sdk.client import ChanField, LidarScan, ScanSource, destagger, FieldClass, XYZLut
+from ouster.sdk.client import ChanField, LidarScan, ScanSource, XYZLut
 from ouster.sdk import open_source
 from ouster.sdk.client._utils import AutoExposure, BeamUniformityCorrector
-from ouster.sdk.viz import SimpleViz
+
+import wire
+from hub import BroadcastHub
+from pipeline import StagedPipeline
+from geometry import GeometryCache
+from instance_stats import instance_statistics
+from image_codec import CODECS, ImageEncoder
+from point_filter import PointFilter, load_polygon
+from background import RangeBackground
+from gating import MotionGate
+from tracks import TrackStore
+from metrics import Metrics, serve_metrics
+from recording import Player, Recorder, Replay, parse_time
+from result_cache import DiskResultCache, MemoryResultCache, source_namespace
+from backends import BACKENDS, MODEL_SIZES, load_model
+from tiling import InferenceWindows, parse_roi
+from ingest import ScanPrefetcher
+from shm_ring import ShmRing
+from topics import DEFAULT, Demand, FrameProducts, Subscription, topic_of
+
+logger = logging.getLogger(__name__)
+
+
+def make_tracker(tracker_cfg="botsort.yaml", frame_rate=30):
+    """
+    Creates a tracker configured like the one model.track(persist=True) creates internally.
+    """
+    with open(check_yaml(tracker_cfg)) as f:
+        cfg = IterableSimpleNamespace(**yaml.safe_load(f))
+    return TRACKER_MAP[cfg.tracker_type](args=cfg, frame_rate=frame_rate)
+
+
+# Channels corrected with the BeamUniformityCorrector, SIGNAL is left as it is
+BUC_CHANNELS = {ChanField.NEAR_IR, ChanField.REFLECTIVITY}
+CHANNEL_LABELS = {ChanField.NEAR_IR: "NEAR IR", ChanField.REFLECTIVITY: "RIFLETTANZA", ChanField.SIGNAL: "SIGNAL"}
+
+
+def parse_channel(name):
+    field = getattr(ChanField, name.strip().upper(), None)
+    if field is None:
+        raise ValueError(f"canale sconosciuto: {name}")
+    return field
+
+
+def parse_channels(spec):
+    """
+    Parses a channel set like "REFLECTIVITY:1,NEAR_IR:4" into a list of (ChanField, cadence): every channel is
+    processed on one scan out of cadence (1 when omitted).
+    """
+    channels = []
+    for item in spec.split(","):
+        name, _, cadence = item.strip().partition(":")
+        field = parse_channel(name)
+        cadence = int(cadence) if cadence else 1
+        if cadence < 1:
+            raise ValueError(f"{name}: la cadenza deve essere almeno 1")
+        channels.append((field, cadence))
+    return channels
+
+
+def parse_headless(spec):
+    # "all" or a comma separated list of channels, see ScanIterator headless
+    if spec.strip().lower() == "all":
+        return True
+    return [parse_channel(name) for name in spec.split(",")]
+
+
+def track_results(tracker, results: Results) -> Results:
+    """
+    Updates the tracker with the detections of a (cpu) Results, like the ultralytics tracking callback does, and
+    returns the tracked results with the track ID's in results.boxes.id.
+    """
+    det = results.boxes.cpu().numpy()
+    tracks = tracker.update(det, results.orig_img)
+    if len(tracks) == 0:
+        return results
+    idx = tracks[:, -1].astype(int)
+    results = results[idx]
+    results.update(boxes=torch.as_tensor(tracks[:, :-1]))
+    return results
+
+
+# Erosion applied to the instance masks to remove small outliers
+EROSION_KERNEL = np.ones((5, 5), np.uint8)
+# Masks eroded together as the channels of a single image. OpenCV limits the number of channels of an image
+MAX_ERODE_CHANNELS = 128
+
+
+class ScanFrame:
+    """
+    A scan travelling through the ScanIterator stages, together with everything computed from it so far.
+    Per-channel lists are indexed like ScanIterator.paired_list.
+    """
+
+    def __init__(self, scan: LidarScan):
+        self.scan = scan
+        self.active = []  # channels processed on this scan, the lists below hold None for the others
+        self.img_mono = []  # destaggered, exposure corrected float32 images
+        self.img_rgb = []  # 3 channel uint8 YOLO inputs
+        self.results = []  # YOLO Results
+        self.frame_count = 0
+        self.timings = {}  # seconds spent on the scan by every stage, and by some steps within them
+        self.timestamp = 0.0  # seconds, drives the track velocities
+        self.detections = []  # detections of the display channel sent to the websocket clients
+        self.channel_detections = []  # detections of every channel, the display channel ones are the same as above
+        self.overlay_inputs = []  # what ScanIterator.overlay_images() needs to draw the overlays of every channel
+        self.overlays = []  # overlay images of every channel, once drawn
+        self.geometry = None  # ScanGeometry: destaggered xyz, range and validity shared by all channels
+        self.foreground = None  # (h, w) bool returns not matching the static background, None without the model
+        self.reflectivity = None  # destaggered raw REFLECTIVITY
+        self.run_inference = True  # False when the motion gate found no change since the last inference
+        self.cache_key = None  # key of the scan in the result cache
+        self.messages = None  # websocket messages served from the result cache, the stages skip the scan
+        self.valid_reflectivity = np.empty(0, np.float32)
+        self.valid_instance_id = np.empty(0, np.uint32)
 
 
 class ScanIterator(ScanSource):
@@ -31,32 +154,63 @@ class ScanIterator(ScanSource):
     else:
         DEVICE = "cpu"
 
-    def __init__(self, scans: ScanSource, use_opencv=False):
+    def __init__(self, scans: ScanSource, use_opencv=False, point_format="binary", point_channels=(),
+                 image_encoder=None, point_filter=None, background=False, keyframe_interval=100, motion_gate=None,
+                 track_options=None, channels=None, display_channel=ChanField.REFLECTIVITY, model=None,
+                 result_cache=None, rois=None, tile_width=0, tile_overlap=0.2, sensor=0, extrinsics=None,
+                 headless=()):
         self._use_opencv = use_opencv
         self._metadata = scans.metadata
-        self._prev_object_positions_NIR = {}  # instance_id -> xyz
-        self._prev_object_positions_REF = {}
-        self._prev_object_positions_SIG = {}
-        self._vel_to_send = {}
-        self._detections_to_send = []
+        # Index of the sensor in a multi-sensor setup, carried by every message sent to the clients
+        self.sensor = sensor
+        self._point_format = point_format  # "binary" (wire.KIND_POINTS) or "json" (list of {x, y, z})
+        self._point_channels = tuple(point_channels)  # optional per-point channels: "reflectivity", "instance_id"
+        self._image_encoder = image_encoder if image_encoder is not None else ImageEncoder()
+        self._point_filter = point_filter if point_filter is not None else PointFilter()
+        # Optional static background model: only the foreground is streamed every frame, the static cloud is sent
+        # as an occasional keyframe
+        self._background = None
+        if background:
+            self._background = RangeBackground((self._metadata.format.pixels_per_column,
+                                                self._metadata.format.columns_per_frame))
+        self._keyframe_interval = keyframe_interval
+        self._keyframe_requested = threading.Event()
+        self._last_keyframe_frame = -keyframe_interval
+        self.keyframe = None  # last static keyframe message
+
+        # Optional MotionGate skipping inference on scans where nothing changed
+        self._gate = motion_gate
+        # Optional cache of the encoded messages of every scan, for sources replayed in a loop
+        self._result_cache = result_cache
+        # Optional ROIs/tiles inferred instead of the whole panorama, the results are mapped back to the full image
+        self._windows = None
+        if rois or tile_width > 0:
+            h, w = self._metadata.format.pixels_per_column, self._metadata.format.columns_per_frame
+            self._windows = InferenceWindows(h, w, rois, tile_width, tile_overlap)
+            logger.info("Inferenza su %d finestre, %.0f%% dell'immagine", len(self._windows.windows),
+                        100 * self._windows.pixels / (h * w))
         self._frame_count = 0
+        self._scan_period = 1.0 / (self._metadata.format.fps or 10)  # used when a scan carries no timestamps
+        self._scan_index = 0
 
         # converting range data to XYZ point clouds
         self._xyzlut = XYZLut(self._metadata)
-        self._valid_points = []
+        # Destaggered xyz/range computed once per scan, see GeometryCache.reserve() when pipelining the stages.
+        # With the extrinsics of the sensor, positions and points are in the common station frame
+        self.geometry = GeometryCache(self._metadata, self._xyzlut, extrinsics=extrinsics)
 
 
         self._generate_rgb_table()
 
         # Load yolo pretrained model.
-        # The example runs yolo on both near infrared and reflectivity channels so we create two independent models
-        self.model_yolo_nir = YOLO("yolo11l-seg.pt").to(device=self.DEVICE)
-        self.model_yolo_ref = YOLO("yolo11l-seg.pt").to(device=self.DEVICE)
-        self.model_yolo_sig = YOLO("yolo11l-seg.pt").to(device=self.DEVICE)
+        # A single set of weights runs all the channels as one batch, while every channel keeps its own tracker so
+        # that instance ID's persist independently per field. Any object with the names and predict() of a YOLO model
+        # can be given instead (e.g. the stub model of benchmark.py)
+        self.model_yolo = model if model is not None else YOLO("yolo11l-seg.pt").to(device=self.DEVICE)
 
         # Define classes to output results for.
         self.name_to_class = {}  
-        for key, value in self.model_yolo_nir.names.items():
+        for key, value in self.model_yolo.names.items():
             self.name_to_class[value] = key
         
         # For now we are only interested in persons
@@ -64,14 +218,34 @@ class ScanIterator(ScanSource):
             self.name_to_class['person'],
         ]
 
+        # Tracked positions and Kalman velocities of every channel, see TrackStore
+        track_options = track_options or {}
+
+        # Channels to process and their cadence (processed on one scan out of cadence). Only the display channel
+        # reaches the websocket clients, so it has to be processed on every scan
+        if channels is None:
+            channels = [(ChanField.NEAR_IR, 1), (ChanField.REFLECTIVITY, 1), (ChanField.SIGNAL, 1)]
+        cadences = dict(channels)
+        if cadences.get(display_channel) != 1:
+            raise ValueError(f"il canale {display_channel} deve essere elaborato ad ogni scansione")
+        self.display_channel = display_channel
+
         # Post-process the near_ir, and cal ref data to make it more camera-like using the
-        # AutoExposure and BeamUniformityCorrector utility functions
+        # AutoExposure and BeamUniformityCorrector utility functions. The trackers of the slower channels see fewer
+        # frames per second, so their track buffer is scaled accordingly
         self.paired_list = [
-            [ChanField.NEAR_IR, AutoExposure(), BeamUniformityCorrector(), self.model_yolo_nir, self._prev_object_positions_NIR],
-            [ChanField.REFLECTIVITY, AutoExposure(), BeamUniformityCorrector(), self.model_yolo_ref, self._prev_object_positions_REF],
-            [ChanField.SIGNAL, AutoExposure(), BeamUniformityCorrector(), self.model_yolo_sig, self._prev_object_positions_SIG]
+            [field, AutoExposure(), BeamUniformityCorrector() if field in BUC_CHANNELS else None,
+             make_tracker(frame_rate=max(1, round(30 / cadence))), TrackStore(**track_options), cadence]
+            for field, cadence in channels
         ]
+        self._last_results = [None] * len(self.paired_list)
+        # Headless channels only produce detections and track states: their overlay images (results plot, instance
+        # colors) are not drawn nor added to the scan, overlay_images() draws them only if a consumer asks for them
+        self._headless = [headless is True or field in headless for field, *_ in self.paired_list]
+        self._display_index = [field for field, *_ in self.paired_list].index(display_channel)
+        self._stacked_result_rgb = None
 
+        self.source = scans
         self._scans = map(partial(self._update), scans)
 
     # Return the scans iterator when instantiating the class
@@ -85,7 +259,7 @@ class ScanIterator(ScanSource):
         # Make some colors for visualizing bounding boxes
         np.random.seed(0)
         N_COLORS = 256
-        scalarMap = cm.ScalarMappable(norm=mpl.colors.Normalize(vmin=0, vmax=1.0), cmap=mpl.pyplot.get_cmap('hsv'))
+        scalarMap = cm.ScalarMappable(norm=mpl.colors.Normalize(vmin=0, vmax=1.0), cmap=mpl.colormaps['hsv'])
         self._mono_to_rgb_lut = np.clip(0.25 + 0.75 * scalarMap.to_rgba(np.random.random_sample((N_COLORS)))[:, :3], 0, 1)
         self._mono_to_rgb_lut = self._mono_to_rgb_lut.astype(np.float32)
 
@@ -106,190 +280,306 @@ class ScanIterator(ScanSource):
         return rgb
 
     def _update(self, scan: LidarScan) -> LidarScan:
-        self._last_centroids_REF = []
-        self._last_velocities_REF = []
-        self._last_xyz_points = None
-        self._valid_points = []
-        self._detections_to_send = []
+        # Runs all the processing stages sequentially, see stages() for running them in a pipeline
+        frame = scan
+        for _, stage in self.stages():
+            frame = stage(frame)
+        return frame.scan
 
-        stacked_result_rgb = np.empty((scan.h * len(self.paired_list), scan.w, 3), np.uint8)
-        for i, (field, ae, buc, model, prev_object_positions) in enumerate(self.paired_list):
+    def stages(self):
+        """
+        Returns the (name, function) processing stages of a scan, in order. The first stage takes a LidarScan and
+        returns a ScanFrame, the following ones take and return that ScanFrame. Every stage only touches the state
+        of its own stage (exposure correctors, trackers, track stores), so different stages can work on
+        different frames at the same time. The time spent by every stage is recorded in ScanFrame.timings.
+        Scans served from the result cache go through the stages untouched.
+        """
+        return [
+            ("ingest", self._stage("ingest", self.ingest)),
+            ("preprocess", self._stage("preprocess", self.preprocess)),
+            ("inference", self._stage("inference", self.inference)),
+            ("postprocess", self._stage("postprocess", self.postprocess)),
+        ]
+
+    @staticmethod
+    def _stage(name, stage):
+        def run(item):
+            if isinstance(item, ScanFrame) and item.messages is not None:
+                return item
+            start = time.perf_counter()
+            frame = stage(item)
+            frame.timings[name] = time.perf_counter() - start
+            return frame
+        return run
 
-            # Destagger the data to get a human-interpretable, camera-like image
-            img_mono = destagger(self._metadata, scan.field(field)).astype(np.float32)
+    def ingest(self, scan: LidarScan) -> "ScanFrame":
+        frame = ScanFrame(scan)
+        # Counted here, before the result cache, so that cached scans keep the frame numbering and the cadence phase
+        scan_index = self._scan_index
+        self._scan_index += 1
+        self._frame_count += 1
+        frame.frame_count = self._frame_count
+        # Acquisition time of the scan from the first valid column, or the nominal period if the source has none
+        timestamps = scan.timestamp[scan.timestamp != 0]
+        if timestamps.size > 0:
+            frame.timestamp = float(timestamps[0]) * 1e-9
+        else:
+            frame.timestamp = scan_index * self._scan_period
+        if self._result_cache is not None:
+            # Already processed on a previous lap of the source: nothing left to compute. A requested keyframe
+            # needs the geometry of the scan, the scan is processed again to send it
+            frame.cache_key = (scan.frame_id, int(timestamps[0]) if timestamps.size > 0 else -1)
+            if self._background is None or not self._keyframe_requested.is_set():
+                frame.messages = self._result_cache.get(frame.cache_key)
+            if frame.messages is not None:
+                return frame
+        # It's more intuitive to work in human-viewable image-space so we destagger the xyz and range data once for
+        # all the channels
+        frame.geometry = self.geometry.compute(scan)
+        frame.reflectivity = self.geometry.destagger(scan.field(ChanField.REFLECTIVITY))
+        if self._background is not None:
+            frame.foreground = self._background.update(frame.geometry.range_mm, frame.geometry.valid)
+        if self._gate is not None:
+            frame.run_inference = self._gate.check(frame.geometry.range_mm, frame.reflectivity)
+        # Channels processed on this scan, the others are skipped by all the following stages
+        frame.active = [scan_index % cadence == 0 for *_, cadence in self.paired_list]
+        frame.img_mono = [None] * len(self.paired_list)
+        frame.img_rgb = [None] * len(self.paired_list)
+        frame.results = [None] * len(self.paired_list)
+        for i, (field, *_) in enumerate(self.paired_list):
+            if frame.active[i]:
+                # Destagger the data to get a human-interpretable, camera-like image
+                frame.img_mono[i] = self.geometry.destagger(scan.field(field)).astype(np.float32)
+        return frame
+
+    def preprocess(self, frame: "ScanFrame") -> "ScanFrame":
+        for i, (field, ae, buc, tracker, tracks, cadence) in enumerate(self.paired_list):
+            if not frame.active[i]:
+                continue
+            img_mono = frame.img_mono[i]
             # Make the image more uniform and better exposed to make it similar to camera data YOLO is trained on
             ae(img_mono)
-            if i != 2: # Non applicare la correzione del segnale
+            if buc is not None:
                 buc(img_mono, update_state=True)
 
             # Convert to 3 channel uint8 for YOLO inference
-            img_rgb = np.repeat(np.uint8(np.clip(np.rint(img_mono*255), 0, 255))[..., np.newaxis], 3, axis=-1)
-
-            # Run inference with the tracker module enabled so that instance ID's persist across frames
-            results: Results = next(
-                model.track(
-                    [img_rgb],
-                    stream=True,  # Reduce memory requirements for streaming
-                    persist=True,  # Maintain tracks across sequential frames
-                    conf=0.25,  # Confidence threshold
-                    imgsz=[img_rgb.shape[0], img_rgb.shape[1]],
-                    classes=self.classes_to_detect
-                )
-            ).cpu()
-
-            # Plot results using the ultralytics results plotting. You can skip this if you'd rather use the
-            # create_filled_masks functionality
-            img_rgb_with_results = results.plot(boxes=True, masks=True, line_width=1, font_size=3)
+            frame.img_rgb[i] = np.repeat(np.uint8(np.clip(np.rint(img_mono*255), 0, 255))[..., np.newaxis], 3, axis=-1)
+        return frame
+
+    def inference(self, frame: "ScanFrame") -> "ScanFrame":
+        active = [i for i, run in enumerate(frame.active) if run]
+        if not frame.run_inference:
+            # Nothing changed in the scene: carry the last tracked results forward on the new images
+            for i in active:
+                if self._last_results[i] is not None:
+                    results = copy.copy(self._last_results[i])
+                    results.orig_img = frame.img_rgb[i]
+                    frame.results[i] = results
+
+        # Run the channels due on this scan as a single batch through the shared model
+        todo = [i for i in active if frame.results[i] is None]
+        if not todo:
+            return frame
+        if self._windows is None:
+            batch = [frame.img_rgb[i] for i in todo]
+            batch_results = self.model_yolo.predict(
+                batch,
+                conf=0.25,  # Confidence threshold
+                imgsz=[batch[0].shape[0], batch[0].shape[1]],
+                classes=self.classes_to_detect,
+                verbose=logger.isEnabledFor(logging.DEBUG)  # una riga per immagine ad ogni frame, solo in debug
+            )
+        else:
+            # The windows of all the channels in a single batch, then back to one full image Results per channel
+            batch = [window for i in todo for window in self._windows.crop(frame.img_rgb[i])]
+            window_results = self.model_yolo.predict(
+                batch,
+                conf=0.25,  # Confidence threshold
+                imgsz=self._windows.imgsz,
+                classes=self.classes_to_detect,
+                retina_masks=True,  # masks at window resolution, pasted back into the full image
+                verbose=logger.isEnabledFor(logging.DEBUG)
+            )
+            n = len(self._windows.windows)
+            batch_results = [self._windows.merge(window_results[k * n:(k + 1) * n], frame.img_rgb[i])
+                             for k, i in enumerate(todo)]
+        for i, results in zip(todo, batch_results):
+            # Run the tracker of the channel so that instance ID's persist across frames
+            tracker = self.paired_list[i][3]
+            frame.results[i] = track_results(tracker, results.cpu())
+            self._last_results[i] = frame.results[i]
+        return frame
+
+    def postprocess(self, frame: "ScanFrame") -> "ScanFrame":
+        scan = frame.scan
+        geometry = frame.geometry
+        xyz_meters = geometry.xyz
+        range_mm = geometry.range_mm
+        valid = geometry.valid
+        if self._use_opencv and self._stacked_result_rgb is None:
+            # Kept across frames, the rows of the channels skipped on a scan show their last results
+            self._stacked_result_rgb = np.zeros((scan.h * len(self.paired_list), scan.w, 3), np.uint8)
+        stacked_result_rgb = self._stacked_result_rgb
+        frame.channel_detections = [[] for _ in self.paired_list]
+        frame.overlay_inputs = [None] * len(self.paired_list)
+        frame.overlays = [None] * len(self.paired_list)
+        for i, (field, ae, buc, tracker, tracks, cadence) in enumerate(self.paired_list):
+            if not frame.active[i]:
+                continue
+            img_mono = frame.img_mono[i]
+            results = frame.results[i]
+
             if self._use_opencv:
                 # Save stacked RGB images for opencv viewing
-                stacked_result_rgb[i * scan.h:(i + 1) * scan.h, ...] = img_rgb_with_results
-            else:
-                # Add a custom RGB results field to allow for displaying in SimpleViz
-                scan.add_field(f"YOLO_RESULTS_{field}", destagger(self._metadata, img_rgb_with_results, inverse=True))
-
-                # Alternative method for generating filled mask instance and class images
-                # CAREFUL: These images are destaggered - human viewable. Whereas the raw field data in a LidarScan
-                # is staggered.
-                instance_id_img, class_id_img, instance_ids, class_ids = self.create_filled_masks(results, scan)
-
-                # Example: Get xyz and range data slices that correspond to each instance id
-                xyz_meters = self._xyzlut(scan.field(ChanField.RANGE))  # Get the xyz pointcloud for the entire LidarScan
-                range_mm = scan.field(ChanField.RANGE)
-
-                # It's more intuitive to work in human-viewable image-space so we choose to destagger the xyz and range data
-                xyz_meters = destagger(self._metadata, xyz_meters)
-                range_mm = destagger(self._metadata, range_mm)
-
-                valid = range_mm != 0  # Ignore non-detected points
-                if field == ChanField.REFLECTIVITY:
-                    # Salva i punti validi per il campo REFLECTIVITY
-                    self._valid_points = [{"x": p[0], "y": p[1], "z": p[2]} for p in xyz_meters[valid]]
-
-                
-                # Crea una copia modificabile dell'immagine delle istanze
-                instance_id_img_with_median = instance_id_img.copy()
-
-                # Convertiamo l'immagine in uint8 per il disegno
-                instance_id_img_with_median = instance_id_img_with_median.astype(np.uint8)
-
-                # Per salvare output da stampare a fine ciclo
-                velocity_info = []
-                position_info = []
-                for instance_id in instance_ids:
-                    data_slice = (instance_id_img == instance_id) & valid
-                    xyz_slice = xyz_meters[data_slice, :]
-                    if xyz_slice.shape[0] == 0:
-                        continue
+                if not self._headless[i]:
+                    frame.overlay_inputs[i] = (results, img_mono, None, ())
+                    stacked_result_rgb[i * scan.h:(i + 1) * scan.h, ...] = self.overlay_images(frame, i)[0]
+                continue
+
+            # Alternative method for generating filled mask instance and class images
+            # CAREFUL: These images are destaggered - human viewable. Whereas the raw field data in a LidarScan
+            # is staggered.
+            start = time.perf_counter()
+            instance_id_img, class_id_img, instance_ids, class_ids = self.create_filled_masks(results, scan)
+            frame.timings["masks"] = frame.timings.get("masks", 0.0) + time.perf_counter() - start
+
+            # Example: Get xyz and range data slices that correspond to each instance id, using the destaggered
+            # geometry shared by all the channels
+            if field == self.display_channel:
+                # Salva i canali per punto del canale mostrato ai client, come array senza creare oggetti per punto
+                frame.valid_reflectivity = frame.reflectivity[valid]
+                frame.valid_instance_id = instance_id_img[valid]
 
-                    median_xyz = np.median(xyz_slice, axis=0)
-                    # Calcolo velocità se abbiamo la posizione precedente
-                    if instance_id in prev_object_positions:
-                        prev_xyz = prev_object_positions[instance_id]
-                        delta_t = 0.1  # secondi tra due frame consecutivi
-                        velocity = (median_xyz - prev_xyz) / delta_t
+            # Per salvare output da loggare a fine ciclo, solo se il livello DEBUG è attivo
+            verbose = logger.isEnabledFor(logging.DEBUG)
+            velocity_info = []
+            position_info = []
+            # Statistiche di tutte le istanze in un solo passaggio sui pixel etichettati
+            start = time.perf_counter()
+            stats = instance_statistics(instance_id_img, xyz_meters, range_mm, valid)
+            frame.timings["instance_stats"] = frame.timings.get("instance_stats", 0.0) + time.perf_counter() - start
+            # Velocità stimate dal filtro di Kalman di ogni traccia, con il tempo reale tra le scansioni
+            _, velocities, first_seen = tracks.update(stats.ids, stats.median_xyz, frame.timestamp)
+            for instance_id, median_xyz, median_range_mm, velocity, new in zip(
+                    stats.ids.tolist(), stats.median_xyz, stats.median_range_mm, velocities, first_seen):
+                if not new:
+                    if verbose:
                         velocity_info.append(f"ID {instance_id}: velocità = {velocity[0]:.2f}, {velocity[1]:.2f}, {velocity[2]:.2f} m/s")
-                        if field == ChanField.REFLECTIVITY:
-                            self._detections_to_send.append({
-                                "id": int(instance_id),
-                                "position":{
-                                    "x": float(median_xyz[0]),
-                                    "y": float(median_xyz[1]),
-                                    "z": float(median_xyz[2])
-                                },
-                                "velocity": {
-                                    "vx": float(velocity[0]),
-                                    "vy": float(velocity[1]),
-                                    "vz": float(velocity[2])
-                                }
-                            })
-                    else:
-                        velocity_info.append(f"ID {instance_id}: prima osservazione, velocità non disponibile.")
-                        if field == ChanField.REFLECTIVITY:
-                            self._vel_to_send[instance_id] = np.array([0.0, 0.0, 0.0])
-
-                    # Aggiorna la posizione
-                    prev_object_positions[instance_id] = median_xyz
-
-                    range_slice_mm = range_mm[data_slice]
+                    frame.channel_detections[i].append({
+                        "id": instance_id,
+                        "position":{
+                            "x": float(median_xyz[0]),
+                            "y": float(median_xyz[1]),
+                            "z": float(median_xyz[2])
+                        },
+                        "velocity": {
+                            "vx": float(velocity[0]),
+                            "vy": float(velocity[1]),
+                            "vz": float(velocity[2])
+                        }
+                    })
+                elif verbose:
+                    velocity_info.append(f"ID {instance_id}: prima osservazione, velocità non disponibile.")
+
+                if verbose:
                     position_info.append(
-                        f"ID {instance_id}: {np.median(range_slice_mm)/1000:0.2f} m, {np.array2string(median_xyz, precision=2)} m")
-                    # Trova il pixel più vicino alla mediana
-                    dists = np.linalg.norm(xyz_meters - median_xyz, axis=-1)
-                    idx = np.unravel_index(np.argmin(dists), dists.shape)
-
-                    cv2.circle(instance_id_img_with_median, (idx[1], idx[0]), radius=1, color=(255,0,0), thickness=-1)
-                
-                print("\n\n\n\n\FRAME: ", self._frame_count)
-                if i == 2: 
-                    self._frame_count += 1
-                    print("\n###SIGNAL###")
-                elif i == 1:
-                    print("\n###RIFLETTANZA###")
-                else:
-                    print("\n###NEAR IR###")
-                print("VELOCITÀ:")
-                for line in velocity_info:
-                    print(line)
-
-                print("\nPOSIZIONE:")
-                for line in position_info:
-                    print(line)
-
-                # Aggiungi il campo al LidarScan per visualizzazione in SimpleViz
-                scan.add_field(f"INSTANCE_ID_{field}", destagger(self._metadata, self.mono_to_rgb(instance_id_img_with_median, img_mono), inverse=True))
-                scan.add_field(f"RGB_INSTANCE_ID_{field}", destagger(self._metadata, self.mono_to_rgb(instance_id_img, img_mono), inverse=True))
-        
+                        f"ID {instance_id}: {median_range_mm/1000:0.2f} m, {np.array2string(median_xyz, precision=2)} m")
+            if field == self.display_channel:
+                frame.detections = frame.channel_detections[i]
+
+            if verbose:
+                logger.debug("FRAME %d ###%s###\nVELOCITÀ:\n%s\nPOSIZIONE:\n%s", frame.frame_count,
+                             CHANNEL_LABELS.get(field, field), "\n".join(velocity_info), "\n".join(position_info))
+
+            frame.overlay_inputs[i] = (results, img_mono, instance_id_img, stats.closest_pixel)
+            if not self._headless[i]:
+                # Aggiungi i campi al LidarScan per visualizzazione in SimpleViz
+                start = time.perf_counter()
+                yolo_img, rgb_instance_img, instance_img = self.overlay_images(frame, i)
+                scan.add_field(f"YOLO_RESULTS_{field}", self.geometry.destagger(yolo_img, inverse=True))
+                scan.add_field(f"INSTANCE_ID_{field}", self.geometry.destagger(instance_img, inverse=True))
+                scan.add_field(f"RGB_INSTANCE_ID_{field}", self.geometry.destagger(rgb_instance_img, inverse=True))
+                frame.timings["overlays"] = frame.timings.get("overlays", 0.0) + time.perf_counter() - start
+
         # Display in the loop with opencv
         if self._use_opencv:
             cv2.imshow("results", stacked_result_rgb)
             cv2.waitKey(1)
 
-        return scan
+        return frame
 
 
+    def overlay_images(self, frame: ScanFrame, i):
+        """
+        Returns the destaggered overlay images of the i-th channel of a processed scan: the plotted YOLO results
+        (uint8 RGB), the instance colors over the channel image and the same with the pixel closest to the median
+        of every instance marked (float RGB in 0-1). Drawn on first use and kept in the frame, so the headless
+        channels only pay for them when a consumer (e.g. a websocket client subscribed to the images) asks.
+        """
+        if frame.overlays[i] is None:
+            results, img_mono, instance_id_img, anchors = frame.overlay_inputs[i]
+            # Plot results using the ultralytics results plotting
+            yolo_img = results.plot(boxes=True, masks=True, line_width=1, font_size=3)
+            rgb_instance_img = instance_img = None
+            if instance_id_img is not None:
+                rgb_instance_img = self.mono_to_rgb(instance_id_img, img_mono)
+                # Copia uint8 dell'immagine delle istanze per il disegno, con il pixel più vicino alla mediana
+                instance_id_img_with_median = instance_id_img.astype(np.uint8)
+                for row, col in anchors:
+                    cv2.circle(instance_id_img_with_median, (int(col), int(row)), radius=1, color=(255,0,0), thickness=-1)
+                instance_img = self.mono_to_rgb(instance_id_img_with_median, img_mono)
+            frame.overlays[i] = (yolo_img, rgb_instance_img, instance_img)
+        return frame.overlays[i]
+
     def create_filled_masks(self, results: Results, scan: LidarScan):
         instance_ids = np.empty(0, np.uint32)  # Keep track of which instances are kept
         class_ids = np.empty(0, np.uint32)  # Keep track of which classes are kept
+        instance_id_img = np.zeros((scan.h, scan.w), np.uint32)
         if results.boxes.id is not None and results.masks is not None:
-            mask_edges = results.masks.xy
             orig_instance_ids = np.uint32(results.boxes.id.int())
             orig_class_ids = np.uint32(results.boxes.cls.int())
-            # opencv drawContours requires 3-channel float32 image. We'll convert back to uint32 at the end
-            instance_id_img = np.zeros((scan.h, scan.w, 3), np.float32)
-            # Process ids in reverse order to ensure older instances overwrite newer ones in case of overlap
-            masks_list = list(results.masks.data)
 
-            
             """
             #VERSIONE SENZA EROSIONE CHE FUNZIONA MA HA più OUTLIER
-            for edge, instance_id, class_id in zip(mask_edges[::-1], orig_instance_ids[::-1], orig_class_ids[::-1]):
+            for edge, instance_id, class_id in zip(results.masks.xy[::-1], orig_instance_ids[::-1], orig_class_ids[::-1]):
                 if len(edge) != 0:  # It is possible to have an instance with zero edge length. Error check this case
                     instance_id_img = cv2.drawContours(instance_id_img, [np.int32([edge])], -1, color=[np.float64(instance_id), 0, 0], thickness=-1)
                     instance_ids = np.append(instance_ids, instance_id)
                     class_ids = np.append(class_ids, class_id)
             """
-            
 
-            for mask, instance_id, class_id in zip(masks_list[::-1], orig_instance_ids[::-1], orig_class_ids[::-1]):
+            # Move all the masks to the cpu in a single transfer
+            masks = results.masks.data.cpu().numpy().astype(np.uint8) * 255
+            n, mask_h, mask_w = masks.shape
 
-                mask_np = mask.cpu().numpy().astype(np.uint8) * 255
-                # Applica erosione per rimuovere piccoli outlier
-                kernel = np.ones((5, 5), np.uint8)  # Puoi aumentare la dimensione se serve più erosione
-                eroded_mask = cv2.erode(mask_np, kernel, iterations=1)
+            # Applica erosione per rimuovere piccoli outlier, a gruppi di maschere come canali di una sola immagine
+            eroded = np.empty_like(masks)
+            for start in range(0, n, MAX_ERODE_CHANNELS):
+                chunk = np.ascontiguousarray(masks[start:start + MAX_ERODE_CHANNELS].transpose(1, 2, 0))
+                chunk = cv2.erode(chunk, EROSION_KERNEL, iterations=1).reshape(mask_h, mask_w, -1)
+                eroded[start:start + MAX_ERODE_CHANNELS] = chunk.transpose(2, 0, 1)
 
-                # Contorna la maschera erosa
-                contours, _ = cv2.findContours(eroded_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            # Fill the external contours of every eroded mask (this also fills the holes inside the masks)
+            filled = np.zeros((n, scan.h, scan.w), np.uint8)
+            has_contours = np.zeros(n, bool)
+            for k in range(n):
+                contours, _ = cv2.findContours(eroded[k], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
                 if contours:
-                    instance_id_img = cv2.drawContours(instance_id_img, contours, -1, color=[np.float64(instance_id), 0, 0], thickness=-1)
-                    instance_ids = np.append(instance_ids, instance_id)
-                    class_ids = np.append(class_ids, class_id)
-            instance_id_img = instance_id_img[..., 0].astype(np.uint32)  # Convert to 1-channel image
-            # Remove any instance_ids that were fully overwritten by an overlapping mask
-            in_bool = np.isin(instance_ids, instance_id_img)
-            instance_ids = instance_ids[in_bool]
-            class_ids = class_ids[in_bool]
-        else:
-            instance_id_img = np.zeros((scan.h, scan.w), np.uint32)
+                    cv2.drawContours(filled[k], contours, -1, color=1, thickness=-1)
+                    has_contours[k] = True
+
+            # Older instances (lower index) win in case of overlap: label every pixel with its first covering mask
+            covered = filled.any(axis=0)
+            first = filled.argmax(axis=0) if n > 0 else np.zeros((scan.h, scan.w), np.intp)
+            instance_id_img[covered] = orig_instance_ids[first[covered]]
+
+            # Ids in the same order as drawing the masks from the newest to the oldest. Remove any instance_ids
+            # that were fully overwritten by an overlapping mask
+            visible = np.zeros(n, bool)
+            visible[first[covered]] = True
+            kept = np.flatnonzero(has_contours & visible)[::-1]
+            instance_ids = orig_instance_ids[kept]
+            class_ids = orig_class_ids[kept]
 
         # Last step make the class id image using a lookup table from instances to classes
         if instance_ids.size > 0:
@@ -300,77 +590,706 @@ class ScanIterator(ScanSource):
             class_id_img = np.zeros((scan.h, scan.w), np.uint32)
 
         return instance_id_img, class_id_img, instance_ids, class_ids
-    
-    async def send_results_via_websocket(self, websocket, scan: LidarScan):
-        def to_base64(img_array):
-            img_pil = Image.fromarray(img_array)
-            buffered = io.BytesIO()
-            img_pil.save(buffered, format="PNG")
-            return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
-        try:
-            # Ottieni immagini YOLO e RGB istanza
-            yolo_img = destagger(self._metadata, scan.field("YOLO_RESULTS_REFLECTIVITY"))
-            rgb_instance_img = destagger(self._metadata, scan.field("RGB_INSTANCE_ID_REFLECTIVITY"))
-
-            # Estrai punti XYZ validi (range ≠ 0)
-            xyz_meters = self._xyzlut(scan.field(ChanField.RANGE))
-            xyz_meters = destagger(self._metadata, xyz_meters)
-            range_mm = destagger(self._metadata, scan.field(ChanField.RANGE))
-            valid = range_mm != 0
-            valid_points = [{"x": p[0], "y": p[1], "z": p[2]} for p in xyz_meters[valid]]
-
-            # Invia tutto separatamente
-            await websocket.send(json.dumps({
-                "type": "point",
-                "data": valid_points
-            }))
+    def encode_results(self, frame: ScanFrame, demand=None):
+        """
+        Encodes the results of a processed scan into the FrameProducts sent to the clients: only the topics, point
+        budgets and image scales in demand (a topics.Demand), everything at the default variants if None.
+        """
+        demand = demand if demand is not None else Demand([DEFAULT])
+        # The subscriptions of a scheduled demand get this frame, see BroadcastHub
+        subscriptions = demand.subscriptions if demand.scheduled else None
+        if frame.messages is not None:
+            return FrameProducts.from_messages(self._restamp(frame), self.sensor, subscriptions)
+        start = time.perf_counter()
+        scan = frame.scan
+        products = FrameProducts(self.sensor, subscriptions)
 
-            await websocket.send(json.dumps({
+        # Ottieni immagini YOLO e RGB istanza, codificate in parallelo dal pool dell'encoder, una volta per scala
+        images = []
+        if "images" in demand:
+            # Already drawn for the SimpleViz fields, or drawn now for a headless display channel
+            yolo_img, rgb_instance_img, _ = self.overlay_images(frame, self._display_index)
+            rgb_instance_img = (rgb_instance_img * 255).astype(np.uint8)
+            for scale in demand.image_scales:
+                if scale != 1.0:
+                    size = (max(1, round(scan.w * scale)), max(1, round(scan.h * scale)))
+                    yolo_scaled = cv2.resize(yolo_img, size, interpolation=cv2.INTER_AREA)
+                    instance_scaled = cv2.resize(rgb_instance_img, size, interpolation=cv2.INTER_AREA)
+                else:
+                    yolo_scaled, instance_scaled = yolo_img, rgb_instance_img
+                images.append((scale, self._image_encoder.submit(yolo_scaled),
+                               self._image_encoder.submit(instance_scaled)))
+
+        if "points" in demand:
+            for budget, messages in self.encode_points(frame, demand.point_budgets).items():
+                products.add("points", messages, budget)
+        if "detections" in demand:
+            products.add("detections", [json.dumps({
                 "type": "detections",
-                "data": self._detections_to_send
-            }))
+                "sensor": self.sensor,
+                "data": frame.detections
+            })])
+        for scale, image1, image2 in images:
+            products.add("images", [
+                wire.encode_image(image1.result(), wire.IMAGE_RESULTS, self._image_encoder.codec, frame.frame_count,
+                                  sensor=self.sensor),
+                wire.encode_image(image2.result(), wire.IMAGE_INSTANCES, self._image_encoder.codec, frame.frame_count,
+                                  sensor=self.sensor),
+            ], scale)
+        if "frame" in demand:
+            products.add("frame", [json.dumps({
+                "type": "frame",
+                "sensor": self.sensor,
+                "frame": frame.frame_count,
+                "inference_skipped": not frame.run_inference
+            })])
+        frame.timings["encode"] = time.perf_counter() - start
+        # Only complete frames are cached, a partial one is encoded again on the next lap
+        if self._result_cache is not None and demand.complete:
+            self._result_cache.put(frame.cache_key, products.messages())
+        return products
 
-            await websocket.send(json.dumps({
-                "type": "image1",
-                "data": to_base64(yolo_img)
-            }))
+    def _restamp(self, frame: ScanFrame):
+        # The cached messages of a scan carry the frame counter of the lap they were encoded on, they are sent with
+        # the current one
+        messages = []
+        for message in frame.messages:
+            if not isinstance(message, str):
+                message = wire.restamp(message, frame.frame_count)
+                if wire.is_keyframe(message):
+                    self.keyframe = message
+                    self._last_keyframe_frame = frame.frame_count
+            elif topic_of(message) == "frame":
+                message = json.dumps(dict(json.loads(message), frame=frame.frame_count))
+            messages.append(message)
+        return messages
 
-            await websocket.send(json.dumps({
-                "type": "image2",
-                "data": to_base64((rgb_instance_img * 255).astype(np.uint8))
-            }))
+    def encode_points(self, frame: ScanFrame, point_budgets=(0,)):
+        """
+        Returns the point messages of a processed scan for every point budget (0 = the budget of the point filter).
+        Without background model this is the whole cloud. With the background model it is only the foreground of
+        the frame, preceded now and then (or when a client asks for it) by a keyframe with the static background,
+        which is shared by all the budgets and also kept in self.keyframe.
+        """
+        geometry = frame.geometry
+        # I punti delle persone rilevate restano a densità piena, lo sfondo viene sfoltito
+        detected = frame.valid_instance_id != 0
+        if frame.foreground is None:
+            return {budget: [self._encode_point_layer(frame, wire.LAYER_FULL, dense=detected, point_budget=budget)]
+                    for budget in point_budgets}
 
-            await websocket.send(json.dumps({
-                "type": "frame",
-                "frame": self._frame_count
-            }))
+        foreground = frame.foreground[geometry.valid] | detected
+        keyframe = []
+        if (self._keyframe_requested.is_set()
+                or frame.frame_count - self._last_keyframe_frame >= self._keyframe_interval):
+            self._keyframe_requested.clear()
+            self._last_keyframe_frame = frame.frame_count
+            self.keyframe = self._encode_point_layer(frame, wire.LAYER_STATIC, subset=~foreground)
+            keyframe = [self.keyframe]
+        return {budget: keyframe + [self._encode_point_layer(frame, wire.LAYER_FOREGROUND, subset=foreground,
+                                                             dense=foreground, point_budget=budget)]
+                for budget in point_budgets}
+
+    def keyframes(self):
+        # Static keyframes to send to a client joining the stream, as Replay.keyframes()
+        return [self.keyframe] if self.keyframe is not None else []
 
-        except Exception as e:
-            print("Errore durante l'invio WebSocket:", e)
+    def request_keyframe(self):
+        # The next encoded frame will include a fresh static keyframe
+        self._keyframe_requested.set()
 
+    def _encode_point_layer(self, frame: ScanFrame, layer, subset=None, dense=None, point_budget=0):
+        """
+        Encodes the valid points selected by `subset` (all of them if None), either as a binary wire.KIND_POINTS
+        message or as the legacy JSON "point" message. The points are thinned by the point filter first, if
+        configured, except the `dense` ones. A point_budget asked by a client is capped by the configured one.
+        """
+        geometry = frame.geometry
+        xyz = geometry.valid_xyz
+        range_mm = geometry.range_mm[geometry.valid]
+        pixels = geometry.valid_pixels
+        reflectivity = frame.valid_reflectivity
+        instance_id = frame.valid_instance_id
+        if subset is not None:
+            xyz, range_mm, pixels = xyz[subset], range_mm[subset], pixels[subset]
+            reflectivity, instance_id = reflectivity[subset], instance_id[subset]
+            dense = None if dense is None else dense[subset]
+        configured = self._point_filter.point_budget
+        if point_budget <= 0 or 0 < configured < point_budget:
+            point_budget = configured
+        if self._point_filter.enabled or point_budget > 0:
+            dense = np.zeros(xyz.shape[0], bool) if dense is None else dense
+            keep = self._point_filter.select(xyz, range_mm, dense, pixels, geometry.valid.size, point_budget)
+            xyz, reflectivity, instance_id = xyz[keep], reflectivity[keep], instance_id[keep]
+
+        if self._point_format == "json":
+            return json.dumps({
+                "type": "point",
+                "sensor": self.sensor,
+                "layer": layer,
+                "data": [{"x": x, "y": y, "z": z} for x, y, z in xyz.tolist()]
+            })
+        return wire.encode_points(
+            xyz,
+            frame.frame_count,
+            reflectivity=reflectivity if "reflectivity" in self._point_channels else None,
+            instance_id=instance_id if "instance_id" in self._point_channels else None,
+            sensor=self.sensor,
+            layer=layer,
+        )
+
+
+def parse_source(spec):
+    """
+    Parses a source "PATH[@IDX]": a sensor hostname or PCAP/OSF file, optionally followed by the index of the
+    sensor within a multi-sensor recording (0 when omitted).
+    """
+    path, separator, index = spec.rpartition("@")
+    if separator and index.isdigit():
+        return path, int(index)
+    return spec, 0
+
+
+def load_extrinsics(path, count):
+    # JSON list of 4x4 sensor to station transforms in meters, one per source in the order they are given
+    with open(path) as f:
+        matrices = [np.asarray(matrix, np.float64) for matrix in json.load(f)]
+    if len(matrices) != count or any(matrix.shape != (4, 4) for matrix in matrices):
+        raise ValueError(f"{path}: attese {count} matrici 4x4, una per sorgente")
+    return matrices
+
+
+def create_pipeline(args, source, sensor_idx=0, sensor=0, extrinsics=None, demand=None, recorder=None):
+    """
+    Builds the ScanIterator of one sensor, the StagedPipeline running its stages and the metrics of its processing.
+    The encode stage only encodes what demand() (a topics.Demand, everything if None) asks for, plus the default
+    stream when recording. Returns (scans, pipeline, metrics, image_encoder).
+    """
+    image_encoder = ImageEncoder(args.image_codec, args.image_quality, args.encoder_threads)
+    point_filter = PointFilter(crop_box=args.crop_box,
+                               crop_polygon=load_polygon(args.crop_polygon) if args.crop_polygon else None,
+                               voxel_size=args.voxel_size, decimate_range=args.decimate_range,
+                               point_budget=args.point_budget)
+    motion_gate = None
+    if args.motion_gate:
+        motion_gate = MotionGate(min_changed_pixels=args.gate_min_pixels, hold_frames=args.gate_hold,
+                                 idle_interval=args.gate_idle_interval)
+    result_cache = None
+    if args.result_cache != 'off':
+        # Everything that changes the messages of a scan is part of the cache namespace
+        options = {key: value for key, value in vars(args).items()
+                   if key not in ('result_cache', 'result_cache_size', 'result_cache_dir', 'client_queue',
+                                  'stage_queue', 'encoder_threads', 'metrics_port', 'stats_interval', 'log_level',
+                                  'record', 'source', 'extrinsics', 'inference_process', 'shm_slots',
+                                  'shm_slot_mb', 'ingest_thread', 'ingest_buffer')}
+        options.update(sensor_idx=sensor_idx, sensor=sensor,
+                       extrinsics=None if extrinsics is None else np.asarray(extrinsics).tolist())
+        namespace = source_namespace(source, {key: str(value) for key, value in options.items()})
+        if namespace is None:
+            logger.warning("La cache dei risultati richiede un file PCAP/OSF come sorgente, disattivata")
+        elif args.result_cache == 'memory':
+            result_cache = MemoryResultCache(namespace, args.result_cache_size * 2**20)
+        else:
+            result_cache = DiskResultCache(args.result_cache_dir, namespace, args.result_cache_size * 2**20)
+    model = load_model(args.model_size, args.backend, args.int8, args.model_dir, ScanIterator.DEVICE)
+    scan_source = open_source(source, sensor_idx=sensor_idx, cycle=True)
+    # Un sensore live va letto di continuo, anche durante l'inferenza. Un file invece non perde pacchetti:
+    # leggerlo in anticipo scarterebbe solo delle scansioni
+    prefetcher = None
+    if args.ingest_thread == 'on' or (args.ingest_thread == 'auto' and not os.path.isfile(source)):
+        prefetcher = scan_source = ScanPrefetcher(scan_source, args.ingest_buffer)
+    scans = ScanIterator(scan_source, use_opencv=False,
+                         point_format=args.point_format, point_channels=args.point_channels,
+                         image_encoder=image_encoder, point_filter=point_filter,
+                         background=args.background, keyframe_interval=args.keyframe_interval,
+                         motion_gate=motion_gate,
+                         track_options=dict(capacity=args.track_capacity, ttl=args.track_ttl),
+                         channels=args.channels, display_channel=args.display_channel,
+                         result_cache=result_cache, model=model,
+                         rois=args.roi, tile_width=args.tile_width, tile_overlap=args.tile_overlap,
+                         sensor=sensor, extrinsics=extrinsics, headless=args.headless)
+    metrics = Metrics()
+    frames_total = metrics.counter("frames_total", "Scans processed by the pipeline")
+    inference_skipped = metrics.counter("inference_skipped_total", "Scans on which the motion gate skipped inference")
+    stage_seconds = metrics.histogram("stage_seconds", "Time spent on a scan by every stage and step", ("stage",))
+    detections = metrics.gauge("detections", "Detections sent with the last frame")
 
+    def encode(frame):
+        # Codifica una sola volta per tutti i client solo quello che almeno uno di loro ha chiesto (tutto se si
+        # sta registrando)
+        wanted = demand() if demand is not None else Demand([DEFAULT])
+        if args.record:
+            wanted = wanted.including(DEFAULT)
+        products = scans.encode_results(frame, wanted) if wanted else None
+        if recorder is not None:
+            recorder.write(frame.frame_count, products.messages(), frame.timestamp)
+        frames_total.inc()
+        if not frame.run_inference:
+            inference_skipped.inc()
+        for name, seconds in frame.timings.items():
+            stage_seconds.observe(seconds, stage=name)
+        if frame.messages is None:
+            # Cached scans carry only their encoded messages, the gauge keeps the last computed value
+            detections.set(len(frame.detections))
+        return products
+
+    # ingest/destagger -> preprocessing -> inference -> post-processing -> encoding, ognuno nel suo thread
+    stages = scans.stages() + [("encode", encode)]
+    # Ogni stage ha un frame in lavorazione più quelli nella sua coda di ingresso
+    scans.geometry.reserve(len(stages) * (args.stage_queue + 1))
+    pipeline = StagedPipeline(scans.source, stages, queue_size=args.stage_queue)
+
+    metrics.gauge("queue_depth", "Frames waiting in the output queue of every stage", ("stage",),
+                  fn=pipeline.queue_sizes)
+    metrics.counter("stage_errors_total", "Scans dropped because a stage raised", ("stage",),
+                    fn=lambda: dict(pipeline.errors))
+    metrics.counter("stage_dropped_total", "Scans a stage did not pass on (e.g. not encoded without clients)",
+                    ("stage",), fn=lambda: dict(pipeline.dropped))
+    metrics.gauge("tracks", "Tracks kept per channel", ("channel",),
+                  fn=lambda: {field: len(tracks) for field, _, _, _, tracks, _ in scans.paired_list})
+    if prefetcher is not None:
+        metrics.counter("ingest_scans_received_total", "Scans read from the sensor", fn=lambda: prefetcher.received)
+        metrics.counter("ingest_scans_dropped_total", "Complete scans dropped because the pipeline was busy",
+                        fn=lambda: prefetcher.dropped)
+        metrics.counter("ingest_scans_incomplete_total", "Partial scans discarded (UDP packets lost)",
+                        fn=lambda: prefetcher.incomplete)
+        metrics.gauge("ingest_buffered", "Complete scans waiting for the pipeline", fn=lambda: len(prefetcher))
+    if result_cache is not None:
+        metrics.counter("result_cache_hits_total", "Scans served from the result cache", fn=lambda: result_cache.hits)
+        metrics.counter("result_cache_misses_total", "Scans not found in the result cache",
+                        fn=lambda: result_cache.misses)
+        metrics.gauge("result_cache_bytes", "Size of the result cache", fn=lambda: result_cache.size_bytes)
+    return scans, pipeline, metrics, image_encoder
+
+
+def add_hub_metrics(metrics, hub):
+    metrics.gauge("clients", "Connected websocket clients", fn=lambda: len(hub.subscribers))
+    metrics.counter("frames_published_total", "Frames published to the websocket clients", fn=lambda: hub.published)
+    metrics.counter("client_frames_dropped_total", "Frames dropped because a client was too slow",
+                    fn=lambda: hub.dropped)
+    metrics.gauge("topic_subscribers", "Connected clients subscribed to every topic", ("topic",),
+                  fn=hub.topic_counts)
 
 
 async def process_and_send(args):
-    scans = ScanIterator(open_source(args.source, sensor_idx=0, cycle=True), use_opencv=False)
+    sources = [parse_source(spec) for spec in args.source]
+    if len(sources) > 1 or args.inference_process:
+        await serve_sensors(args, sources)
+        return
+    (source, sensor_idx), = sources
+    extrinsics = load_extrinsics(args.extrinsics, 1)[0] if args.extrinsics else None
+    hub = BroadcastHub(max_queue=args.client_queue)
+    recorder = Recorder(args.record) if args.record else None
+    scans, pipeline, metrics, image_encoder = create_pipeline(args, source, sensor_idx, extrinsics=extrinsics,
+                                                              demand=lambda: hub.demand.due(),
+                                                              recorder=recorder)
+    add_hub_metrics(metrics, hub)
+
+    metrics_server = await serve_metrics(metrics, "localhost", args.metrics_port) if args.metrics_port else None
+    stats_task = asyncio.create_task(publish_stats(hub, metrics, args.stats_interval)) if args.stats_interval else None
+
+    async with websockets.serve(lambda ws: scan_handler(ws, hub, scans), "localhost", 8000):
+        logger.info("WebSocket server avviato su ws://localhost:8000")
+        try:
+            await produce_frames(pipeline, hub)
+        finally:
+            image_encoder.shutdown()
+            if recorder is not None:
+                recorder.close()
+            if stats_task is not None:
+                stats_task.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
+
+
+class SensorGroup:
+    """
+    Stands for the ScanIterators of the sensor processes in scan_handler: keeps the last static keyframe of every
+    sensor seen in the merged stream and forwards keyframe requests to all the processes.
+    """
+
+    def __init__(self):
+        self._keyframes = {}  # sensor -> last static keyframe message
+        self._requests = []  # one multiprocessing.Event per sensor process
+
+    def add(self, keyframe_requested):
+        self._requests.append(keyframe_requested)
+
+    def update(self, products):
+        for messages in products.products.values():
+            for message in messages:
+                if wire.is_keyframe(message):
+                    self._keyframes[message[2]] = message
+
+    def keyframes(self):
+        return [self._keyframes[sensor] for sensor in sorted(self._keyframes)]
+
+    def request_keyframe(self):
+        for keyframe_requested in self._requests:
+            keyframe_requested.set()
 
-    async with websockets.serve(lambda ws: scan_handler(ws, scans), "localhost", 8000):
-        print("WebSocket server avviato su ws://localhost:8000")
-        await asyncio.Future()  # Keep server running
 
-async def scan_handler(websocket, scans):
+def sensor_worker(args, sensor, source, sensor_idx, extrinsics, ring_name, demands, keyframe_requested):
+    """
+    Entry point of the process running the pipeline of one sensor. The FrameProducts of every frame go to the
+    websocket server process through the shared memory ring ring_name (see shm_ring.py), the server only reads
+    the freshest ones. demands brings the topics.Demand of the clients whenever it changes.
+    """
+    logging.basicConfig(level=args.log_level,
+                        format=f'%(asctime)s %(levelname)s sensore {sensor} %(name)s: %(message)s')
+    # terminate() dal server: si esce dal loop, così run_sensor ferma la pipeline e chiude il sensore
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    asyncio.run(run_sensor(args, sensor, source, sensor_idx, extrinsics, ring_name, demands, keyframe_requested))
+
+
+async def run_sensor(args, sensor, source, sensor_idx, extrinsics, ring_name, demands, keyframe_requested):
+    demand = Demand()
+
+    def latest_demand():
+        # Il worker codifica solo quello che chiedono i client del server (o tutto se registra)
+        nonlocal demand
+        try:
+            while True:
+                demand = demands.get_nowait()
+        except queue.Empty:
+            pass
+        return demand
+
+    scans, pipeline, metrics, image_encoder = create_pipeline(args, source, sensor_idx, sensor, extrinsics,
+                                                              demand=latest_demand)
+    ring = ShmRing.attach(ring_name)
+    metrics.counter("shm_frames_oversized_total", "Frames dropped because larger than a shared memory slot",
+                    fn=lambda: ring.oversized)
+    # Le metriche di ogni sensore sulle porte successive a quella del server
+    port = args.metrics_port + 1 + sensor if args.metrics_port else 0
+    metrics_server = await serve_metrics(metrics, "localhost", port) if port else None
+    loop = asyncio.get_running_loop()
+    pipeline.start()
     try:
-        for scan in scans:
-            await scans.send_results_via_websocket(websocket, scan)
-    except websockets.exceptions.ConnectionClosed:
-        print("Connessione WebSocket chiusa dal client")
+        while True:
+            products = await loop.run_in_executor(None, pipeline.get)
+            if products is None:
+                break
+            if keyframe_requested.is_set():
+                keyframe_requested.clear()
+                scans.request_keyframe()
+            ring.write(products)
+    finally:
+        pipeline.stop()
+        image_encoder.shutdown()
+        ring.close()
+        if metrics_server is not None:
+            metrics_server.close()
+
+
+# Seconds between two checks of the shared memory rings for a new frame
+SHM_POLL_INTERVAL = 0.002
+
+
+async def serve_sensors(args, sources):
+    """
+    Runs the pipeline of every sensor in its own process (YOLO, trackers and encoding hold the GIL for long
+    stretches, so threads would not scale) and merges their frames into a single websocket stream. Every message
+    is tagged with the index of its sensor: byte 2 of the binary header, "sensor" of the JSON messages. The frames
+    come through a shared memory ring per sensor, this process only serves the clients.
+    """
+    context = multiprocessing.get_context("spawn")
+    extrinsics = load_extrinsics(args.extrinsics, len(sources)) if args.extrinsics else [None] * len(sources)
+    group = SensorGroup()
+    workers = []
+    for sensor, ((source, sensor_idx), matrix) in enumerate(zip(sources, extrinsics)):
+        ring = ShmRing.create(args.shm_slots, args.shm_slot_mb * 2**20)
+        demands = context.Queue()
+        keyframe_requested = context.Event()
+        process = context.Process(target=sensor_worker, name=f"sensor-{sensor}", daemon=True,
+                                  args=(args, sensor, source, sensor_idx, matrix, ring.name, demands,
+                                        keyframe_requested))
+        process.start()
+        group.add(keyframe_requested)
+        workers.append((sensor, process, ring, demands))
+        logger.info("Sensore %d: %s (indice %d), processo %d", sensor, source, sensor_idx, process.pid)
+
+    hub = BroadcastHub(max_queue=args.client_queue)
+    recorder = Recorder(args.record) if args.record else None
+    metrics = Metrics()
+    add_hub_metrics(metrics, hub)
+    metrics.gauge("sensors_running", "Sensor processes alive",
+                  fn=lambda: sum(process.is_alive() for _, process, _, _ in workers))
+    metrics.counter("shm_frames_skipped_total", "Frames overwritten in the shared memory ring before being read",
+                    ("sensor",), fn=lambda: {sensor: ring.skipped for sensor, _, ring, _ in workers})
+    metrics.counter("shm_reads_torn_total", "Reads of a shared memory slot retried because it was being rewritten",
+                    ("sensor",), fn=lambda: {sensor: ring.torn for sensor, _, ring, _ in workers})
+    metrics_server = await serve_metrics(metrics, "localhost", args.metrics_port) if args.metrics_port else None
+    stats_task = asyncio.create_task(publish_stats(hub, metrics, args.stats_interval)) if args.stats_interval else None
+
+    loop = asyncio.get_running_loop()
+    recorded = itertools.count(1)
+
+    async def forward(sensor, process, ring, demands):
+        # Pubblica i frame di un sensore man mano che arrivano, senza allinearli a quelli degli altri
+        last = 0
+        while True:
+            if ring.last_frame <= last:
+                if not process.is_alive():
+                    logger.error("Il processo del sensore %d è terminato (codice %s)", sensor, process.exitcode)
+                    return
+                await asyncio.sleep(SHM_POLL_INTERVAL)
+                continue
+            # La copia dallo slot (qualche MB) fuori dal loop asyncio
+            last, products = await loop.run_in_executor(None, ring.read, last)
+            products.sensor = sensor
+            group.update(products)
+            if recorder is not None:
+                recorder.write(next(recorded), products.messages())
+            hub.publish(products)
+
+    async def share_demand():
+        # I worker ricevono le sottoscrizioni dei client quando cambiano, per codificare solo ciò che serve. Il
+        # limite di frequenza di ogni client si applica qui, nell'hub
+        shared = Demand()
+        while True:
+            if hub.demand != shared:
+                shared = hub.demand
+                for *_, demands in workers:
+                    demands.put(shared)
+            await asyncio.sleep(0.1)
+
+    demand_task = asyncio.create_task(share_demand())
+    async with websockets.serve(lambda ws: scan_handler(ws, hub, group), "localhost", 8000):
+        logger.info("WebSocket server avviato su ws://localhost:8000 con %d sensori", len(workers))
+        try:
+            await asyncio.gather(*(forward(*worker) for worker in workers))
+        finally:
+            demand_task.cancel()
+            for _, process, ring, _ in workers:
+                process.terminate()
+                process.join(timeout=5)
+                ring.close()
+            if recorder is not None:
+                recorder.close()
+            if stats_task is not None:
+                stats_task.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
+
+async def replay_and_send(args):
+    # Serve una registrazione con lo stesso protocollo websocket, senza sorgente né modello
+    replay = Replay(Player(args.replay), speed=args.replay_speed, loop=args.replay_loop)
+    if args.replay_from is not None:
+        replay.seek(unix_time=parse_time(args.replay_from))
+    elif args.replay_frame is not None:
+        replay.seek(frame=args.replay_frame, session=args.replay_session)
+    hub = BroadcastHub(max_queue=args.client_queue)
+
+    async with websockets.serve(lambda ws: scan_handler(ws, hub, replay, replay=replay), "localhost", 8000):
+        logger.info("Replay di %s su ws://localhost:8000", args.replay)
+        await replay.run(hub)
+
+async def publish_stats(hub, metrics, interval):
+    # Invia periodicamente a tutti i client un messaggio "stats" con le metriche correnti
+    while True:
+        await asyncio.sleep(interval)
+        if hub.subscribers:
+            hub.publish([json.dumps({"type": "stats", "data": metrics.snapshot()})])
+
+async def produce_frames(pipeline, hub):
+    # Il loop asyncio si limita ad attendere i frame già elaborati e codificati dalla pipeline
+    loop = asyncio.get_running_loop()
+    pipeline.start()
+    try:
+        while True:
+            messages = await loop.run_in_executor(None, pipeline.get)
+            if messages is None:
+                break
+            hub.publish(messages)
+    finally:
+        pipeline.stop()
+
+async def scan_handler(websocket, hub, scans, replay=None):
+    subscriber = hub.subscribe(websocket)
+
+    async def send_frames():
+        try:
+            await subscriber.run()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def receive_commands():
+        try:
+            async for message in websocket:
+                if message == "toggle_pause":
+                    subscriber.paused = not subscriber.paused
+                    hub.update_demand()
+                    logger.info("Paused: %s", subscriber.paused)
+                    continue
+                try:
+                    command = json.loads(message)
+                except (TypeError, ValueError):
+                    continue
+                if not isinstance(command, dict):
+                    continue
+                if command.get("type") == "subscribe":
+                    # Topic, frequenza massima, scala delle immagini e budget di punti di questo client
+                    try:
+                        subscriber.subscription = Subscription.from_command(command)
+                    except (TypeError, ValueError) as e:
+                        await websocket.send(json.dumps({"type": "error", "message": str(e)}))
+                        continue
+                    hub.update_demand()
+                    await websocket.send(subscriber.subscription.to_message())
+                elif command.get("type") == "request_keyframe":
+                    # Invia subito l'ultimo keyframe, fuori dal limite di frequenza del client, e chiedine uno nuovo
+                    # al prossimo frame
+                    keyframes = scans.keyframes()
+                    if keyframes:
+                        subscriber.push(keyframes)
+                    scans.request_keyframe()
+                elif replay is not None and command.get("type") in ("seek", "speed"):
+                    # {"type": "seek", "frame": N[, "session": S]}, {"type": "seek", "time": unix seconds o ISO 8601},
+                    # {"type": "speed", "value": 2.0}
+                    try:
+                        if command["type"] == "speed":
+                            replay.set_speed(float(command.get("value", 1.0)))
+                        elif command.get("frame") is not None:
+                            replay.seek(frame=int(command["frame"]), session=int(command.get("session", -1)))
+                        elif command.get("time") is not None:
+                            replay.seek(unix_time=parse_time(str(command["time"])))
+                    except (TypeError, ValueError, IndexError):
+                        logger.warning("Comando di replay non valido: %s", message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    tasks = [asyncio.create_task(send_frames()), asyncio.create_task(receive_commands())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        hub.unsubscribe(subscriber)
+        logger.info("Connessione WebSocket chiusa dal client: frame inviati %d, scartati %d",
+                    subscriber.sent, subscriber.dropped)
 
 
 if __name__ == '__main__':
     # parse the command arguments
     parser = argparse.ArgumentParser(prog='sdk yolo demo',
                                      description='Runs a minimal demo of yolo post-processing')
-    parser.add_argument('source', type=str, help='Sensor hostname or path to a sensor PCAP or OSF file')
+    parser.add_argument('source', type=str, nargs='*',
+                        help='Sensor hostname or path to a sensor PCAP or OSF file, optionally followed by @IDX to '
+                             'pick a sensor of a multi-sensor recording (not needed with --replay). With several '
+                             'sources every sensor is processed in its own process and the clients get one stream')
+    parser.add_argument('--inference-process', action='store_true',
+                        help='Process a single source in its own process too, leaving this one to the websocket '
+                             'clients (always the case with several sources)')
+    parser.add_argument('--shm-slots', type=int, default=4,
+                        help='Frames of the shared memory ring of every sensor process')
+    parser.add_argument('--shm-slot-mb', type=int, default=16,
+                        help='Size of a frame slot of the shared memory rings in MB, larger frames are dropped')
+    parser.add_argument('--ingest-thread', choices=['auto', 'on', 'off'], default='auto',
+                        help='Read the source in a dedicated thread, dropping the oldest scans when the pipeline '
+                             'is busy and discarding partial ones (auto: for live sensors, not for files)')
+    parser.add_argument('--ingest-buffer', type=int, default=1,
+                        help='Complete scans buffered by the ingest thread (1 = always process the freshest)')
+    parser.add_argument('--extrinsics', type=str, default=None,
+                        help='JSON file with one 4x4 sensor to station transform (meters) per source, in order: '
+                             'points and detections of all the sensors are sent in the common station frame')
+    parser.add_argument('--point-format', choices=['binary', 'json'], default='binary',
+                        help='Wire format of the point cloud messages (binary float32 buffer or legacy JSON)')
+    parser.add_argument('--point-channels', nargs='*', choices=['reflectivity', 'instance_id'], default=[],
+                        help='Optional per-point channels appended to binary point messages')
+    parser.add_argument('--client-queue', type=int, default=2,
+                        help='Frames buffered per websocket client before the oldest ones are dropped')
+    parser.add_argument('--point-budget', type=int, default=0,
+                        help='Maximum number of streamed points per frame, detected persons excluded (0 = unlimited)')
+    parser.add_argument('--voxel-size', type=float, default=0.0,
+                        help='Voxel grid edge in meters used to thin the background points (0 = disabled)')
+    parser.add_argument('--decimate-range', type=float, default=0.0,
+                        help='Background points closer than this many meters are thinned to even out the density '
+                             '(0 = disabled)')
+    parser.add_argument('--crop-box', type=float, nargs=6, default=None,
+                        metavar=('XMIN', 'YMIN', 'ZMIN', 'XMAX', 'YMAX', 'ZMAX'),
+                        help='Only stream the points inside this box (meters, sensor frame, or station frame with '
+                             '--extrinsics)')
+    parser.add_argument('--crop-polygon', type=str, default=None,
+                        help='JSON file with the [x, y] vertices of the area to stream, e.g. the track corridor')
+    parser.add_argument('--background', action='store_true',
+                        help='Learn the static background and stream only the foreground points every frame')
+    parser.add_argument('--keyframe-interval', type=int, default=100,
+                        help='Frames between two keyframes of the static background cloud')
+    parser.add_argument('--motion-gate', action='store_true',
+                        help='Skip inference on scans with no change since the last inference, carrying tracks forward')
+    parser.add_argument('--gate-min-pixels', type=int, default=20,
+                        help='Changed pixels (on a 2x subsampled grid) that wake up inference')
+    parser.add_argument('--gate-hold', type=int, default=10,
+                        help='Scans kept at full inference rate after the last change')
+    parser.add_argument('--gate-idle-interval', type=int, default=0,
+                        help='With no change, still run inference every this many scans (0 = never)')
+    parser.add_argument('--channels', type=parse_channels, default='NEAR_IR,REFLECTIVITY,SIGNAL',
+                        help='Channels to process, each with an optional cadence: "REFLECTIVITY,NEAR_IR:4" processes '
+                             'REFLECTIVITY on every scan and NEAR_IR on one scan out of 4')
+    parser.add_argument('--display-channel', type=parse_channel,
+                        default=ChanField.REFLECTIVITY,
+                        help='Channel whose detections and images are sent to the websocket clients')
+    parser.add_argument('--headless', type=parse_headless, nargs='?', const=True, default=(),
+                        metavar='CHANNELS',
+                        help='Only compute detections and tracks for these channels ("all" or no value for every '
+                             'channel): the overlay images are drawn only when a client subscribes to the images')
+    parser.add_argument('--model-size', choices=MODEL_SIZES, default='l',
+                        help='YOLO11 segmentation model size, from n (fastest) to l (most accurate)')
+    parser.add_argument('--backend', choices=BACKENDS, default='pytorch',
+                        help='Inference backend, onnx and openvino models are created with export_model.py')
+    parser.add_argument('--int8', action='store_true', help='Use the INT8 quantized export of the model')
+    parser.add_argument('--model-dir', type=str, default='.', help='Directory of the exported models')
+    parser.add_argument('--roi', type=parse_roi, action='append', default=None, metavar='AZ0:AZ1[:BEAM0:BEAM1]',
+                        help='Only infer this region of the destaggered image: azimuth in degrees over the image '
+                             'columns (AZ0 > AZ1 wraps around), beams as image rows. Can be repeated')
+    parser.add_argument('--tile-width', type=int, default=0,
+                        help='Split the ROIs into overlapping tiles of this many columns (0 = no tiling)')
+    parser.add_argument('--tile-overlap', type=float, default=0.2,
+                        help='Fraction of a tile shared with its neighbour, objects on the border are merged')
+    parser.add_argument('--track-capacity', type=int, default=256,
+                        help='Maximum number of tracks kept per channel')
+    parser.add_argument('--track-ttl', type=float, default=2.0,
+                        help='Seconds without observations after which a track is forgotten')
+    parser.add_argument('--image-codec', choices=list(CODECS), default='jpeg',
+                        help='Codec of the images sent to the websocket clients')
+    parser.add_argument('--image-quality', type=int, default=85,
+                        help='JPEG/WebP quality of the images sent to the websocket clients (0-100)')
+    parser.add_argument('--encoder-threads', type=int, default=2,
+                        help='Worker threads encoding the images of each frame')
+    parser.add_argument('--stage-queue', type=int, default=1,
+                        help='Frames buffered between two consecutive processing stages')
+    parser.add_argument('--metrics-port', type=int, default=9108,
+                        help='Port of the Prometheus metrics endpoint on localhost (0 = disabled)')
+    parser.add_argument('--stats-interval', type=float, default=0,
+                        help='Seconds between two "stats" websocket messages with the current metrics (0 = never)')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='WARNING',
+                        help='DEBUG logs the position and velocity of every tracked object on every frame')
+    parser.add_argument('--result-cache', choices=['off', 'memory', 'disk'], default='off',
+                        help='Cache the encoded results of every scan of a looping PCAP/OSF source, so that later '
+                             'laps skip the processing')
+    parser.add_argument('--result-cache-size', type=int, default=512,
+                        help='Size bound of the result cache in MB, least recently used scans are evicted')
+    parser.add_argument('--result-cache-dir', type=str, default='.result_cache',
+                        help='Directory of the disk result cache')
+    parser.add_argument('--record', type=str, default=None,
+                        help='Append the messages sent to the clients to this recording (plus its .idx index)')
+    parser.add_argument('--replay', type=str, default=None,
+                        help='Serve a recording instead of processing a source, without loading any model')
+    parser.add_argument('--replay-speed', type=float, default=1.0, help='Playback speed of --replay')
+    parser.add_argument('--replay-loop', action='store_true', help='Start the recording over when it ends')
+    parser.add_argument('--replay-frame', type=int, default=None, help='Start the replay from this frame number')
+    parser.add_argument('--replay-session', type=int, default=-1,
+                        help='Session of --replay-frame when the recording was appended to several times '
+                             '(0 = first, -1 = last)')
+    parser.add_argument('--replay-from', type=str, default=None,
+                        help='Start the replay from this time (unix seconds or ISO 8601, e.g. 2024-05-02T14:30:00)')
     args = parser.parse_args()
-    asyncio.run(process_and_send(args))
\ No newline at end of file
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if args.replay:
+        asyncio.run(replay_and_send(args))
+    elif args.source:
+        asyncio.run(process_and_send(args))
+    else:
+        parser.error('a source or --replay is required')
\ No newline at end of file
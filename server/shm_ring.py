@@ -0,0 +1,148 @@
+"""
+Ring of fixed-layout frame slots in shared memory, handing the encoded frames (topics.FrameProducts) of a sensor
+process to the websocket server process without pickling them and pushing them through a pipe.
+
+One writer (the sensor process) and one reader (the server), no locks: every slot is a seqlock. The writer makes
+the sequence number of the slot odd, copies the messages in, then makes it even again and publishes the frame
+number in the header; the reader copies the newest frame out and accepts it only if the sequence number of the
+slot did not change meanwhile. A reader falling behind simply skips to the newest frame, like the drop-oldest
+queues of hub.py, and the writer never waits for the reader.
+
+Layout of the shared block:
+
+    header  RING_HEADER   magic, number of slots, slot size, number of the last complete frame (0 = none yet)
+    slots   slot_count x slot_size bytes, each one
+        SLOT_HEADER   sequence number (odd while being written), frame number, message count
+        ENTRY x MAX_MESSAGES
+                      topic (index in topics.TOPICS), kind (MESSAGE_TEXT/MESSAGE_BINARY), variant (float64, NaN
+                      for none), offset and size of the payload in the data area
+        data          the payloads, back to back
+"""
+import logging
+import math
+import struct
+import time
+from multiprocessing import shared_memory
+
+from recording import MESSAGE_BINARY, MESSAGE_TEXT
+from topics import TOPICS, FrameProducts
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 0x52575348  # "RWSH"
+RING_HEADER = struct.Struct("<IIQQ")  # magic, slot count, slot size, last frame
+SLOT_HEADER = struct.Struct("<QQI4x")  # sequence, frame, message count
+ENTRY = struct.Struct("<BB6xdQQ")  # topic, kind, variant, offset, size
+MAX_MESSAGES = 64
+_TABLE = SLOT_HEADER.size + MAX_MESSAGES * ENTRY.size
+
+
+class ShmRing:
+    """
+    create() makes a new ring in the server process, attach() opens it by name in the sensor process. Only the
+    creator unlinks the shared memory, on close().
+    """
+
+    def __init__(self, memory, owner):
+        self._memory = memory
+        self._owner = owner
+        self._buffer = memory.buf
+        magic, self.slot_count, self.slot_size, _ = RING_HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{memory.name}: non è un ring di frame")
+        self.name = memory.name
+        self.capacity = self.slot_size - _TABLE  # payload bytes per frame
+        self._frame = 0  # writer: number of the last frame written
+        self.oversized = 0  # writer: frames not written because larger than a slot
+        self.torn = 0  # reader: reads discarded because the writer overwrote the slot meanwhile
+        self.skipped = 0  # reader: frames overwritten before being read
+
+    @classmethod
+    def create(cls, slot_count=4, slot_size=16 * 2**20):
+        memory = shared_memory.SharedMemory(create=True, size=RING_HEADER.size + slot_count * slot_size)
+        RING_HEADER.pack_into(memory.buf, 0, MAGIC, slot_count, slot_size, 0)
+        for i in range(slot_count):
+            SLOT_HEADER.pack_into(memory.buf, RING_HEADER.size + i * slot_size, 0, 0, 0)
+        return cls(memory, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name=name), owner=False)
+
+    def _slot(self, frame):
+        return RING_HEADER.size + (frame % self.slot_count) * self.slot_size
+
+    @property
+    def last_frame(self):
+        return RING_HEADER.unpack_from(self._buffer, 0)[3]
+
+    def write(self, products):
+        """
+        Copies the messages of a FrameProducts into the next slot and publishes it. Returns False, dropping the
+        frame, when it does not fit in a slot.
+        """
+        entries = [(topic, variant, message) for (topic, variant), messages in products.products.items()
+                   for message in messages]
+        payloads = [message.encode() if isinstance(message, str) else message for _, _, message in entries]
+        if len(entries) > MAX_MESSAGES or sum(len(p) for p in payloads) > self.capacity:
+            self.oversized += 1
+            logger.warning("Frame di %d messaggi e %.1f MB non scritto: il ring ha slot da %d messaggi e %.1f MB",
+                           len(entries), sum(len(p) for p in payloads) / 2**20, MAX_MESSAGES, self.capacity / 2**20)
+            return False
+
+        frame = self._frame + 1
+        base = self._slot(frame)
+        sequence = SLOT_HEADER.unpack_from(self._buffer, base)[0]
+        # Odd: the readers ignore the slot until it is complete
+        SLOT_HEADER.pack_into(self._buffer, base, sequence + 1, frame, len(entries))
+        offset = base + _TABLE
+        for k, ((topic, variant, message), payload) in enumerate(zip(entries, payloads)):
+            kind = MESSAGE_TEXT if isinstance(message, str) else MESSAGE_BINARY
+            ENTRY.pack_into(self._buffer, base + SLOT_HEADER.size + k * ENTRY.size, TOPICS.index(topic), kind,
+                            math.nan if variant is None else float(variant), offset, len(payload))
+            self._buffer[offset:offset + len(payload)] = payload
+            offset += len(payload)
+        SLOT_HEADER.pack_into(self._buffer, base, sequence + 2, frame, len(entries))
+        struct.pack_into("<Q", self._buffer, RING_HEADER.size - 8, frame)
+        self._frame = frame
+        return True
+
+    def read(self, after=0):
+        """
+        Returns (frame number, FrameProducts) of the newest complete frame if it is newer than `after`, None
+        otherwise. The messages are copied out of the slot once: str for JSON, bytes for binary messages.
+        """
+        while True:
+            frame = self.last_frame
+            if frame <= after:
+                return None
+            base = self._slot(frame)
+            sequence, slot_frame, count = SLOT_HEADER.unpack_from(self._buffer, base)
+            if sequence % 2 or slot_frame != frame:
+                # Being rewritten by a newer frame, which will be published shortly
+                self.torn += 1
+                time.sleep(0)
+                continue
+            products = FrameProducts()
+            for k in range(count):
+                topic, kind, variant, offset, size = ENTRY.unpack_from(self._buffer, base + SLOT_HEADER.size
+                                                                       + k * ENTRY.size)
+                payload = bytes(self._buffer[offset:offset + size])
+                topic = TOPICS[topic]
+                if math.isnan(variant):
+                    variant = None
+                elif topic == "points":
+                    variant = int(variant)
+                products.products.setdefault((topic, variant), []).append(
+                    payload.decode() if kind == MESSAGE_TEXT else payload)
+            if SLOT_HEADER.unpack_from(self._buffer, base)[0] != sequence:
+                self.torn += 1
+                continue
+            self.skipped += frame - after - 1 if after else 0
+            return frame, products
+
+    def close(self):
+        self._buffer = None
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
@@ -0,0 +1,177 @@
+import numpy as np
+import torch
+from ultralytics.engine.results import Results
+
+# YOLO downsamples by 32, windows are sized in multiples of it so that no letterbox padding is inferred
+STRIDE = 32
+
+# Pixels from the edge of its window within which a box counts as cut by that edge
+BORDER_MARGIN = 4
+
+
+def parse_roi(spec):
+    """
+    Parses an ROI "AZ0:AZ1[:BEAM0:BEAM1]": azimuths in degrees across the destaggered image (0 = first column,
+    360 = last one; AZ0 > AZ1 wraps around the seam) and beams as image rows (0 = top, end excluded).
+    """
+    parts = [float(part) for part in spec.split(":")]
+    if len(parts) not in (2, 4):
+        raise ValueError(f"ROI non valida: {spec}, atteso AZ0:AZ1 oppure AZ0:AZ1:BEAM0:BEAM1")
+    if len(parts) == 2:
+        parts += [0, -1]
+    return tuple(parts)
+
+
+def _span(start, length, size, align):
+    # Grows [start, start + length) to a multiple of align, keeping it inside [0, size)
+    length = min(-(-length // align) * align, size)
+    start = min(max(start, 0), size - length)
+    return start, start + length
+
+
+class InferenceWindows:
+    """
+    The windows of the destaggered image that are inferred instead of the whole panorama: the ROIs, optionally
+    split into overlapping tiles of tile_width columns. crop() cuts the windows out of a channel image and merge()
+    maps the Results of the windows back to a single Results in full image coordinates, merging the detections
+    of an object seen by two overlapping tiles, so the tracker and everything after it see the whole image. Only
+    detections of different tiles are ever merged, and only when one of them is cut by the border of its tile that
+    lies inside the other tile: two people overlapping in the image (e.g. a child in front of an adult) stay two.
+
+    rois: list of (az0, az1, beam0, beam1) as returned by parse_roi (beam1 < 0 means the last beam), or None
+    tile_width: columns of a tile, 0 to infer every ROI as a single window
+    overlap: fraction of tile_width shared by two neighbouring tiles
+    iou_threshold / ios_threshold: detections of the same class cut by a shared tile border are merged when their
+        boxes overlap more than this IoU, or when the smaller one lies inside the other for more than this fraction
+    """
+
+    def __init__(self, height, width, rois=None, tile_width=0, overlap=0.2, iou_threshold=0.5, ios_threshold=0.7):
+        self.height = height
+        self.width = width
+        self.iou_threshold = iou_threshold
+        self.ios_threshold = ios_threshold
+
+        # (row0, row1, col0, col1) of every ROI, wrapping ROIs are split at the seam of the image
+        spans = []
+        for az0, az1, beam0, beam1 in rois or [(0, 360, 0, -1)]:
+            row0, row1 = int(beam0), height if beam1 < 0 else int(beam1)
+            col0, col1 = round(az0 / 360 * width), round(az1 / 360 * width)
+            if col1 <= col0:
+                spans += [(row0, row1, col0, width), (row0, row1, 0, col1)]
+            else:
+                spans.append((row0, row1, col0, col1))
+
+        self.windows = []
+        for row0, row1, col0, col1 in spans:
+            row0, row1 = _span(row0, row1 - row0, height, STRIDE)
+            if col1 - col0 <= 0:
+                continue
+            if tile_width <= 0 or col1 - col0 <= tile_width:
+                col0, col1 = _span(col0, col1 - col0, width, STRIDE)
+                self.windows.append((row0, row1, col0, col1))
+                continue
+            tile = _span(0, tile_width, width, STRIDE)[1]
+            step = max(int(tile * (1 - overlap)) // STRIDE * STRIDE, STRIDE)
+            starts = list(range(col0, col1 - tile, step)) + [col1 - tile]
+            for start in starts:
+                self.windows.append((row0, row1) + _span(start, tile, width, STRIDE))
+        # Drop duplicates, e.g. a short ROI grown to the same window as its neighbour
+        self.windows = list(dict.fromkeys(self.windows))
+        # Without tiles no object is seen twice, there is nothing to merge
+        self.merges = tile_width > 0 and len(self.windows) > 1
+
+    @property
+    def imgsz(self):
+        # Inference size fitting all the windows, smaller windows are letterboxed to it
+        return [max(w[1] - w[0] for w in self.windows), max(w[3] - w[2] for w in self.windows)]
+
+    @property
+    def pixels(self):
+        return sum((row1 - row0) * (col1 - col0) for row0, row1, col0, col1 in self.windows)
+
+    def crop(self, img):
+        return [np.ascontiguousarray(img[row0:row1, col0:col1]) for row0, row1, col0, col1 in self.windows]
+
+    def merge(self, window_results, img):
+        """
+        Maps the Results of the windows of img (in the order of crop(), predicted with retina_masks=True) back to a
+        single Results over img.
+        """
+        boxes, sources, masks = [], [], []
+        for k, ((row0, row1, col0, col1), results) in enumerate(zip(self.windows, window_results)):
+            if results.boxes is None or len(results.boxes) == 0:
+                continue
+            data = results.boxes.data.cpu().numpy().copy()
+            data[:, [0, 2]] += col0
+            data[:, [1, 3]] += row0
+            boxes.append(data[:, :6])
+            sources.append(np.full(len(data), k))
+            if results.masks is not None:
+                window_masks = results.masks.data.cpu().numpy() > 0.5
+                full = np.zeros((len(data), self.height, self.width), bool)
+                full[:, row0:row1, col0:col1] = window_masks[:, :row1 - row0, :col1 - col0]
+                masks.append(full)
+
+        names = window_results[0].names if window_results else {}
+        if not boxes:
+            return Results(img, path="", names=names, boxes=torch.zeros((0, 6)))
+        boxes = np.concatenate(boxes)
+        masks = np.concatenate(masks) if masks else None
+        if self.merges:
+            boxes, masks = self._merge_duplicates(boxes, np.concatenate(sources), masks)
+        return Results(img, path="", names=names, boxes=torch.from_numpy(boxes).float(),
+                       masks=None if masks is None else torch.from_numpy(masks).float())
+
+    def _cut(self, boxes, windows, others):
+        # Whether every box (x0, y0, x1, y1) reaches an edge of its window (row0, row1, col0, col1) that lies inside
+        # the other window, i.e. the object may continue beyond the tile that saw it
+        x0, y0, x1, y1 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+        row0, row1, col0, col1 = windows.T
+        other_row0, other_row1, other_col0, other_col1 = others.T
+        return (((other_col0 < col1) & (col1 < other_col1) & (x1 >= col1 - BORDER_MARGIN))
+                | ((other_col0 < col0) & (col0 < other_col1) & (x0 <= col0 + BORDER_MARGIN))
+                | ((other_row0 < row1) & (row1 < other_row1) & (y1 >= row1 - BORDER_MARGIN))
+                | ((other_row0 < row0) & (row0 < other_row1) & (y0 <= row0 + BORDER_MARGIN)))
+
+    def _merge_duplicates(self, boxes, sources, masks):
+        # Greedy non-maximum merging: the best scoring detection absorbs the overlapping ones of the same class
+        # seen by another overlapping tile across their shared border, growing its box and mask to their union
+        order = np.argsort(-boxes[:, 4], kind="stable")
+        boxes = boxes[order]
+        sources = sources[order]
+        masks = masks[order] if masks is not None else None
+        windows = np.array(self.windows)
+        area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        merged = np.zeros(len(boxes), bool)
+        keep = []
+        for i in range(len(boxes)):
+            if merged[i]:
+                continue
+            keep.append(i)
+            rest = np.flatnonzero(~merged)
+            rest = rest[(rest > i) & (boxes[rest, 5] == boxes[i, 5]) & (sources[rest] != sources[i])]
+            if rest.size == 0:
+                continue
+            own = np.broadcast_to(windows[sources[i]], (rest.size, 4))
+            other = windows[sources[rest]]
+            overlapping = ((np.maximum(own[:, 0], other[:, 0]) < np.minimum(own[:, 1], other[:, 1]))
+                           & (np.maximum(own[:, 2], other[:, 2]) < np.minimum(own[:, 3], other[:, 3])))
+            cut_own = self._cut(np.broadcast_to(boxes[i, :4], (rest.size, 4)), own, other)
+            cut_other = self._cut(boxes[rest, :4], other, own)
+            lt = np.maximum(boxes[rest, :2], boxes[i, :2])
+            rb = np.minimum(boxes[rest, 2:4], boxes[i, 2:4])
+            inter = np.prod(np.clip(rb - lt, 0, None), axis=1)
+            iou = inter / np.maximum(area[rest] + area[i] - inter, 1e-9)
+            ios = inter / np.maximum(np.minimum(area[rest], area[i]), 1e-9)
+            # Only the cut part of an object lies inside its whole: the smaller box must be the cut one
+            smaller_cut = np.where(area[rest] < area[i], cut_other, cut_own)
+            duplicates = rest[overlapping & (((cut_own | cut_other) & (iou > self.iou_threshold))
+                                             | (smaller_cut & (ios > self.ios_threshold)))]
+            if duplicates.size == 0:
+                continue
+            merged[duplicates] = True
+            boxes[i, :2] = np.minimum(boxes[i, :2], boxes[duplicates, :2].min(axis=0))
+            boxes[i, 2:4] = np.maximum(boxes[i, 2:4], boxes[duplicates, 2:4].max(axis=0))
+            if masks is not None:
+                masks[i] |= masks[duplicates].any(axis=0)
+        return boxes[keep], masks[keep] if masks is not None else None
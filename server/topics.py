@@ -0,0 +1,211 @@
+"""
+Topics of the websocket stream and the subscriptions of the clients to them.
+
+    points      wire.KIND_POINTS messages (or the legacy JSON "point"), static keyframes included
+    detections  JSON "detections"
+    images      wire.KIND_IMAGE messages (or the legacy JSON "image1"/"image2")
+    frame       JSON "frame"
+    stats       JSON "stats"
+
+A client subscribes by sending
+
+    {"type": "subscribe", "topics": ["detections", "frame"], "max_rate": 2, "image_scale": 0.5, "point_budget": 20000}
+
+Every field is optional; a client that never subscribes gets every topic at full rate, as before. The server
+answers with a "subscribed" message holding the values in effect. The encode stage only encodes the topics, point
+budgets and image scales some subscriber wants (see Demand), so e.g. a detections-only alarm panel costs no point
+or image encoding at all.
+"""
+import json
+import time
+
+import wire
+
+TOPICS = ("points", "detections", "images", "frame", "stats")  # in the order the messages of a frame are sent
+FRAME_TOPICS = TOPICS[:-1]
+
+# Requested scales are snapped to these, so that few image variants are ever encoded per frame
+IMAGE_SCALES = (1.0, 0.5, 0.25)
+
+# Topic of the JSON messages by "type"
+_JSON_TOPICS = {"point": "points", "detections": "detections", "image1": "images", "image2": "images",
+                "frame": "frame", "stats": "stats"}
+
+# A subscriber is due when at most this fraction of its frame interval is missing, so that the jitter of the scan
+# period does not halve the rate
+RATE_SLACK = 0.1
+
+
+def topic_of(message):
+    if not isinstance(message, str):
+        return "points" if message[0] == wire.KIND_POINTS else "images"
+    # All the messages of server.py are json.dumps({"type": ...}), the type can be read without parsing them
+    prefix = '{"type": "'
+    if message.startswith(prefix):
+        kind = message[len(prefix):message.find('"', len(prefix))]
+    else:
+        kind = json.loads(message).get("type")
+    return _JSON_TOPICS.get(kind, "stats")
+
+
+class Subscription:
+    """
+    What a client asked for: topics, maximum frame rate (0 = every frame), image scale (one of IMAGE_SCALES) and
+    point budget (0 = the budget of the server, which also caps larger requests). The rate applies to the frames of
+    every sensor separately, so that a fast sensor does not take the frames of the others.
+    """
+
+    def __init__(self, topics=TOPICS, max_rate=0.0, image_scale=1.0, point_budget=0):
+        self.topics = frozenset(topics)
+        self.max_rate = max_rate
+        self.image_scale = image_scale
+        self.point_budget = point_budget
+        self._next_due = {}  # sensor -> monotonic time its next frame is due
+
+    @classmethod
+    def from_command(cls, command):
+        # Raises ValueError on unknown topics or invalid values
+        topics = command.get("topics", TOPICS)
+        if isinstance(topics, str):
+            topics = [topics]
+        unknown = set(topics) - set(TOPICS)
+        if unknown:
+            raise ValueError(f"topic sconosciuti: {', '.join(sorted(map(str, unknown)))}")
+        max_rate = float(command.get("max_rate") or 0)
+        scale = float(command.get("image_scale") or 1)
+        point_budget = int(command.get("point_budget") or 0)
+        if max_rate < 0 or scale <= 0 or point_budget < 0:
+            raise ValueError("max_rate, image_scale e point_budget devono essere positivi")
+        # La scala più vicina tra quelle disponibili
+        scale = min(IMAGE_SCALES, key=lambda s: abs(s - scale))
+        return cls(topics, max_rate, scale, point_budget)
+
+    def to_message(self):
+        return json.dumps({"type": "subscribed", "topics": [t for t in TOPICS if t in self.topics],
+                           "max_rate": self.max_rate, "image_scale": self.image_scale,
+                           "point_budget": self.point_budget})
+
+    def variant(self, topic):
+        if topic == "points":
+            return self.point_budget
+        if topic == "images":
+            return self.image_scale
+        return None
+
+    def due(self, now=None, sensor=0):
+        if self.max_rate <= 0:
+            return True
+        now = time.monotonic() if now is None else now
+        return now >= self._next_due.get(sensor, 0.0) - RATE_SLACK / self.max_rate
+
+    def sent(self, now=None, sensor=0):
+        # Schedules the next frame of the sensor after one was queued
+        if self.max_rate > 0:
+            now = time.monotonic() if now is None else now
+            interval = 1 / self.max_rate
+            due = self._next_due.get(sensor, now)
+            # On schedule the phase is kept, so that the jitter of the frames does not lower the rate; after a gap
+            # (or the first frame) the schedule starts over from now
+            self._next_due[sensor] = (due if now - due < interval else now) + interval
+
+
+DEFAULT = Subscription()
+
+
+class Demand:
+    """
+    Union of some subscriptions: the topics, point budgets and image scales the next frame has to be encoded with.
+    A scheduled demand, returned by due(), holds exactly the subscriptions the frame is for.
+    """
+
+    def __init__(self, subscriptions=(), scheduled=False):
+        self.subscriptions = tuple(subscriptions)
+        self.scheduled = scheduled
+        self.topics = frozenset().union(*(s.topics for s in self.subscriptions))
+        self.point_budgets = sorted({s.point_budget for s in self.subscriptions if "points" in s.topics})
+        self.image_scales = sorted({s.image_scale for s in self.subscriptions if "images" in s.topics}, reverse=True)
+
+    def __contains__(self, topic):
+        return topic in self.topics
+
+    def __bool__(self):
+        return not self.topics.isdisjoint(FRAME_TOPICS)
+
+    def __eq__(self, other):
+        return isinstance(other, Demand) and self.key == other.key
+
+    @property
+    def key(self):
+        return self.topics, tuple(self.point_budgets), tuple(self.image_scales)
+
+    @property
+    def complete(self):
+        # Covers every frame topic at the default variants, like the stream of a client that never subscribed
+        return (self.topics.issuperset(FRAME_TOPICS) and DEFAULT.point_budget in self.point_budgets
+                and DEFAULT.image_scale in self.image_scales)
+
+    def due(self, now=None, sensor=0):
+        # The subscriptions that take the next frame of the sensor, the rate limited ones may skip it
+        now = time.monotonic() if now is None else now
+        return Demand((s for s in self.subscriptions if s.due(now, sensor)), scheduled=True)
+
+    def including(self, subscription):
+        return Demand(self.subscriptions + (subscription,), self.scheduled)
+
+
+class FrameProducts:
+    """
+    The messages of a frame by topic and variant (point budget for "points", image scale for "images"), shared by
+    all the subscribers: each one takes the topics and variants of its subscription.
+
+    subscriptions are the subscriptions the frame was encoded for, when their rate limits were already applied by
+    a scheduled Demand; None when the hub has to apply them (frames of other processes, recordings).
+    """
+
+    def __init__(self, sensor=0, subscriptions=None):
+        self.products = {}  # (topic, variant) -> list of messages
+        self.sensor = sensor
+        self.subscriptions = subscriptions
+
+    @classmethod
+    def from_messages(cls, messages, sensor=None, subscriptions=None):
+        # A plain message list (result cache, recording, stats) holds the default variant of its topics. The
+        # sensor is read from the messages if not given
+        products = cls(subscriptions=subscriptions)
+        for message in messages:
+            topic = topic_of(message)
+            products.products.setdefault((topic, DEFAULT.variant(topic)), []).append(message)
+            if sensor is None:
+                if not isinstance(message, str):
+                    sensor = message[2]
+                elif topic == "frame":
+                    sensor = json.loads(message).get("sensor", 0)
+        products.sensor = sensor or 0
+        return products
+
+    def add(self, topic, messages, variant=None):
+        self.products[(topic, variant)] = messages
+
+    def __bool__(self):
+        return bool(self.products)
+
+    @property
+    def rate_limited(self):
+        # Only the frames count against the rate of a subscriber, not the stats
+        return any(topic != "stats" for topic, _ in self.products)
+
+    def select(self, subscription):
+        # Messages of the subscribed topics, falling back to the default variant when the requested one was not
+        # encoded (frames served from the result cache or from a recording)
+        messages = []
+        for topic in TOPICS:
+            if topic in subscription.topics:
+                product = self.products.get((topic, subscription.variant(topic)))
+                if product is None:
+                    product = self.products.get((topic, DEFAULT.variant(topic)), [])
+                messages += product
+        return messages
+
+    def messages(self):
+        # The default variants of all the topics, what a client that never subscribed receives
+        return self.select(DEFAULT)
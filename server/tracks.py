@@ -0,0 +1,119 @@
+import numpy as np
+
+
+class TrackStore:
+    """
+    Fixed-size, array-backed store of the tracked instances of one channel, with a constant-velocity Kalman
+    filter per track driven by the scan timestamps. Memory does not depend on how many tracker IDs have been seen:
+    tracks not observed for ttl seconds are evicted and, when all the slots are taken, the least recently seen
+    track makes room for the new one.
+
+    The three axes are filtered independently with the same noise model, so a track only needs its xyz position,
+    xyz velocity and the three terms of the (shared) 2x2 position/velocity covariance.
+
+    capacity: maximum number of tracks kept
+    ttl: seconds after the last observation before a track is dropped
+    process_noise: acceleration noise spectral density, (m/s^2)^2 / Hz
+    measurement_noise: standard deviation of the measured position, meters
+    initial_velocity_std: standard deviation of the velocity of a new track, m/s
+    """
+
+    def __init__(self, capacity=256, ttl=2.0, process_noise=1.0, measurement_noise=0.05, initial_velocity_std=2.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.process_noise = process_noise
+        self.measurement_variance = measurement_noise ** 2
+        self.initial_velocity_variance = initial_velocity_std ** 2
+        self.ids = np.full(capacity, -1, np.int64)  # -1 marks a free slot
+        self.position = np.zeros((capacity, 3), np.float64)
+        self.velocity = np.zeros((capacity, 3), np.float64)
+        self.covariance = np.zeros((capacity, 3), np.float64)  # position var, position/velocity cov, velocity var
+        self.last_seen = np.zeros(capacity, np.float64)  # seconds
+        self.evicted = 0
+
+    def __len__(self):
+        return int(np.count_nonzero(self.ids >= 0))
+
+    def clear(self):
+        self.ids[:] = -1
+
+    def _expire(self, timestamp):
+        used = self.ids >= 0
+        if np.any(used & (self.last_seen > timestamp)):
+            # Time went backwards (e.g. a recording started over): no track can be continued
+            self.evicted += int(np.count_nonzero(used))
+            self.clear()
+            return
+        expired = used & (timestamp - self.last_seen > self.ttl)
+        self.evicted += int(np.count_nonzero(expired))
+        self.ids[expired] = -1
+
+    def _allocate(self, count, busy):
+        # Free slots first, then the least recently seen tracks not observed in this update
+        free = np.flatnonzero(self.ids < 0)
+        if free.size >= count:
+            return free[:count]
+        candidates = np.flatnonzero((self.ids >= 0) & ~busy)
+        oldest = candidates[np.argsort(self.last_seen[candidates], kind="stable")[:count - free.size]]
+        self.evicted += oldest.size
+        return np.concatenate([free, oldest])
+
+    def update(self, ids, positions, timestamp):
+        """
+        Feeds the measured positions (N, 3) of the instances ids (N,) observed at timestamp (seconds).
+        Returns the filtered positions (N, 3), velocities (N, 3) and a (N,) bool array telling which instances were
+        seen for the first time (their velocity is not available yet). IDs beyond capacity are not tracked.
+        """
+        ids = np.asarray(ids, np.int64)
+        positions = np.asarray(positions, np.float64).reshape(-1, 3)
+        n = ids.size
+        self._expire(timestamp)
+
+        # Slot of every known id, -1 for the new ones
+        match = self.ids[None, :] == ids[:, None]
+        known = match.any(axis=1)
+        slots = np.where(known, match.argmax(axis=1), -1)
+
+        # Predict and correct the known tracks
+        k = slots[known]
+        if k.size > 0:
+            dt = (timestamp - self.last_seen[k])[:, None]
+            q = self.process_noise
+            pp, pv, vv = self.covariance[k].T
+            dt1 = dt[:, 0]
+            pp = pp + 2 * dt1 * pv + dt1 ** 2 * vv + q * dt1 ** 3 / 3
+            pv = pv + dt1 * vv + q * dt1 ** 2 / 2
+            vv = vv + q * dt1
+            predicted = self.position[k] + self.velocity[k] * dt
+
+            s = pp + self.measurement_variance
+            gain_p = (pp / s)[:, None]
+            gain_v = (pv / s)[:, None]
+            innovation = positions[known] - predicted
+            self.position[k] = predicted + gain_p * innovation
+            self.velocity[k] = self.velocity[k] + gain_v * innovation
+            self.covariance[k] = np.stack([(1 - gain_p[:, 0]) * pp, (1 - gain_p[:, 0]) * pv, vv - gain_v[:, 0] * pv], 1)
+            self.last_seen[k] = timestamp
+
+        # Start the new tracks
+        new = ~known
+        count = min(int(np.count_nonzero(new)), self.capacity - k.size)
+        if count > 0:
+            busy = np.zeros(self.capacity, bool)
+            busy[k] = True
+            new_idx = np.flatnonzero(new)[:count]
+            s = self._allocate(count, busy)
+            self.ids[s] = ids[new_idx]
+            self.position[s] = positions[new_idx]
+            self.velocity[s] = 0.0
+            self.covariance[s] = (self.measurement_variance, 0.0, self.initial_velocity_variance)
+            self.last_seen[s] = timestamp
+            slots[new_idx] = s
+
+        # Instances that did not fit report their raw measurement
+        out_position = positions.copy()
+        out_velocity = np.zeros((n, 3), np.float64)
+        tracked = slots >= 0
+        out_position[tracked] = self.position[slots[tracked]]
+        out_velocity[tracked] = self.velocity[slots[tracked]]
+        return out_position, out_velocity, new
@@ -0,0 +1,102 @@
+"""
+Binary websocket messages shared by server.py and the frontend (src/hooks/useWebSocketData.js).
+
+Every binary message starts with a 12 byte little-endian header:
+
+    kind    uint8   message kind (KIND_POINTS, ...)
+    flags   uint8   kind specific flags, e.g. which optional per-point channels follow
+    sensor  uint8   index of the sensor the payload belongs to
+    variant uint8   kind specific variant (cloud layer for KIND_POINTS, image codec for KIND_IMAGE)
+    frame   uint32  frame counter of the scan the payload was produced from
+    count   uint32  number of elements in the payload (points for KIND_POINTS, bytes for KIND_IMAGE)
+
+The header size is a multiple of 4 so the browser can view the payload as typed arrays without copying.
+
+KIND_POINTS payload, in this order:
+    xyz           float32[count * 3]   x0, y0, z0, x1, y1, z1, ...
+    reflectivity  float32[count]       only if flags & POINTS_REFLECTIVITY
+    instance_id   uint32[count]        only if flags & POINTS_INSTANCE_ID
+The layer tells whether the points are the whole cloud (LAYER_FULL), a keyframe of the static background
+(LAYER_STATIC, sent occasionally) or the foreground of the frame only (LAYER_FOREGROUND, drawn over the last
+static keyframe).
+
+KIND_IMAGE payload: the encoded image file (PNG, JPEG or WebP according to variant). flags holds the image slot
+(IMAGE_RESULTS for "image1", IMAGE_INSTANCES for "image2").
+"""
+import struct
+
+import numpy as np
+
+HEADER = struct.Struct("<BBBBII")
+
+KIND_POINTS = 1
+KIND_IMAGE = 2
+
+POINTS_REFLECTIVITY = 0x01
+POINTS_INSTANCE_ID = 0x02
+
+LAYER_FULL = 0
+LAYER_STATIC = 1
+LAYER_FOREGROUND = 2
+
+IMAGE_RESULTS = 1  # YOLO results plotted on the REFLECTIVITY image
+IMAGE_INSTANCES = 2  # instance id colors over the REFLECTIVITY image
+
+CODEC_PNG = 0
+CODEC_JPEG = 1
+CODEC_WEBP = 2
+
+
+def encode_points(xyz, frame, reflectivity=None, instance_id=None, sensor=0, layer=LAYER_FULL):
+    """
+    Packs an (N, 3) xyz array and the optional per-point channels into a KIND_POINTS message.
+    The arrays are cast while being copied into the output buffer, so no intermediate float32 copies are made.
+    """
+    xyz = np.asarray(xyz).reshape(-1, 3)
+    count = xyz.shape[0]
+
+    flags = 0
+    size = HEADER.size + count * 12
+    if reflectivity is not None:
+        flags |= POINTS_REFLECTIVITY
+        size += count * 4
+    if instance_id is not None:
+        flags |= POINTS_INSTANCE_ID
+        size += count * 4
+
+    buffer = bytearray(size)
+    HEADER.pack_into(buffer, 0, KIND_POINTS, flags, sensor, layer, frame, count)
+    offset = HEADER.size
+    np.frombuffer(buffer, "<f4", count * 3, offset).reshape(count, 3)[:] = xyz
+    offset += count * 12
+    if reflectivity is not None:
+        np.frombuffer(buffer, "<f4", count, offset)[:] = reflectivity
+        offset += count * 4
+    if instance_id is not None:
+        np.frombuffer(buffer, "<u4", count, offset)[:] = instance_id
+    return buffer
+
+
+def encode_image(data, slot, codec, frame, sensor=0):
+    """
+    Wraps an already encoded image file into a KIND_IMAGE message.
+    """
+    buffer = bytearray(HEADER.size + len(data))
+    HEADER.pack_into(buffer, 0, KIND_IMAGE, slot, sensor, codec, frame, len(data))
+    buffer[HEADER.size:] = data
+    return buffer
+
+
+def restamp(message, frame):
+    """
+    Copy of a binary message with another frame counter, e.g. a cached message sent again on a later lap.
+    """
+    message = bytearray(message)
+    struct.pack_into("<I", message, 4, frame)
+    return message
+
+
+def is_keyframe(message):
+    # True for a static background keyframe (KIND_POINTS, LAYER_STATIC), whatever the sensor
+    return (not isinstance(message, str) and len(message) >= HEADER.size
+            and message[0] == KIND_POINTS and message[3] == LAYER_STATIC)
@@ -13,7 +13,7 @@ import PointCloudViewer from './components/PointCloudViewer';
 import { useWebSocketData } from './hooks/useWebSocketData';
 
 function App() {
-  const { points, image1, image2, frame, detections, socket } = useWebSocketData('ws://localhost:8000/ws');
+  const { clouds, image1, image2, frame, detections, socket } = useWebSocketData('ws://localhost:8000/ws');
 
   useEffect(() => {
     const handleKeyDown = (e) => {
@@ -128,7 +128,7 @@ function App() {
                 {image1 ? (
                   <Box display="flex" justifyContent="center" sx={{ flexGrow: 1, alignItems: 'center' }}>
                     <img
-                      src={`data:image/png;base64,${image1}`}
+                      src={image1}
                       alt="Immagine 1"
                       style={{
                         width: 'auto',
@@ -154,7 +154,7 @@ function App() {
                 {image2 ? (
                   <Box display="flex" justifyContent="center" sx={{ flexGrow: 1, alignItems: 'center' }}>
                     <img
-                      src={`data:image/png;base64,${image2}`}
+                      src={image2}
                       alt="Immagine 2"
                       style={{
                         width: 'auto',
@@ -206,7 +206,7 @@ function App() {
                 </Typography>
 
                 <Box sx={{ flexGrow: 1, overflow: 'hidden' }}>
-                  <PointCloudViewer frame={frame} points={points} detections={detections} />
+                  <PointCloudViewer clouds={clouds} detections={detections} />
                 </Box>
               </Paper>
             </Box>
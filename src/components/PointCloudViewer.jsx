@@ -1,17 +1,13 @@
-import React, { useMemo } from 'react';
+import React from 'react';
 import { Canvas } from '@react-three/fiber';
 import { Points, PointMaterial, Box, TrackballControls, Text, Billboard} from '@react-three/drei';
 import * as THREE from 'three';
 
-export default function PointCloudViewer({ frame, points, detections }) {
-  const positions = useMemo(() => {
-    if (!points || points.length === 0) {
-      return null; // Nessun punto => non disegnare nulla
-    } else {
-      return new Float32Array(points.flatMap(p => [p.x, p.y, p.z]));
-    }
-  }, [points, frame]);
+// Colore della nuvola di ogni sensore, lo sfondo statico usa la versione più scura
+const SENSOR_COLORS = ['#00ffff', '#ff9800', '#e040fb', '#76ff03'];
 
+export default function PointCloudViewer({ clouds, detections }) {
+  // Una nuvola per sensore: points è già un Float32Array (x0, y0, z0, x1, ...) ricevuto dal WebSocket
   return (
     <Canvas style={{ width: '100%', height: '100%' }}>
       
@@ -51,7 +47,7 @@ export default function PointCloudViewer({ frame, points, detections }) {
           : new THREE.Vector3(1, 0, 0);
 
         return (
-          <group key={idx} position={[position.x, position.y, position.z]}>
+          <group key={`${detection.sensor ?? 0}-${id ?? idx}`} position={[position.x, position.y, position.z]}>
             {/* Bounding box */}
             <Box position={[0, 0, 0]} args={[1, 1, 1]}>
               <meshBasicMaterial color={'white'} wireframe />
@@ -97,18 +93,37 @@ export default function PointCloudViewer({ frame, points, detections }) {
           </group>
         );
       })}
-      {/* Disegna la point cloud se esistono punti */}
-      {positions && (
-        <Points positions={positions} stride={3} frustumCulled={false}>
-          <PointMaterial
-            transparent
-            color="#00ffff"
-            size={0.01}
-            sizeAttenuation={true}
-            depthWrite={false}
-          />
-        </Points>
-      )}
+      {clouds && clouds.map(({ sensor, points, staticPoints }) => {
+        const color = new THREE.Color(SENSOR_COLORS[sensor % SENSOR_COLORS.length]);
+        return (
+          <group key={sensor}>
+            {/* Sfondo statico (keyframe), aggiornato solo di tanto in tanto */}
+            {staticPoints && staticPoints.length > 0 && (
+              <Points positions={staticPoints} stride={3} frustumCulled={false}>
+                <PointMaterial
+                  transparent
+                  color={color.clone().multiplyScalar(0.45)}
+                  size={0.01}
+                  sizeAttenuation={true}
+                  depthWrite={false}
+                />
+              </Points>
+            )}
+            {/* Disegna la point cloud se esistono punti */}
+            {points && points.length > 0 && (
+              <Points positions={points} stride={3} frustumCulled={false}>
+                <PointMaterial
+                  transparent
+                  color={color}
+                  size={0.01}
+                  sizeAttenuation={true}
+                  depthWrite={false}
+                />
+              </Points>
+            )}
+          </group>
+        );
+      })}
     </Canvas>
   );
 }
@@ -1,35 +1,149 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useMemo } from 'react';
 
-export function useWebSocketData(url) {
-  const [points, setPoints] = useState([]);
-  const [detections, setDetections] = useState([]); // <-- nuovo stato per le detections
+// Formato binario dei messaggi, vedi server/wire.py
+const HEADER_SIZE = 12;
+const KIND_POINTS = 1;
+const KIND_IMAGE = 2;
+const POINTS_REFLECTIVITY = 0x01;
+const POINTS_INSTANCE_ID = 0x02;
+const LAYER_FULL = 0;
+const LAYER_STATIC = 1;
+const IMAGE_TYPES = { 1: 'image1', 2: 'image2' };
+const IMAGE_MIME = { 0: 'image/png', 1: 'image/jpeg', 2: 'image/webp' };
+
+function decodeBinaryMessage(buffer) {
+  const view = new DataView(buffer);
+  const kind = view.getUint8(0);
+  const flags = view.getUint8(1);
+  const sensor = view.getUint8(2);
+  const variant = view.getUint8(3);
+  const frame = view.getUint32(4, true);
+  const count = view.getUint32(8, true);
+
+  if (kind === KIND_POINTS) {
+    // Le viste puntano direttamente al buffer ricevuto, senza copie
+    let offset = HEADER_SIZE;
+    const positions = new Float32Array(buffer, offset, count * 3);
+    offset += count * 12;
+    let reflectivity = null;
+    if (flags & POINTS_REFLECTIVITY) {
+      reflectivity = new Float32Array(buffer, offset, count);
+      offset += count * 4;
+    }
+    let instanceId = null;
+    if (flags & POINTS_INSTANCE_ID) {
+      instanceId = new Uint32Array(buffer, offset, count);
+    }
+    return { type: 'point', sensor, frame, layer: variant, positions, reflectivity, instanceId };
+  }
+  if (kind === KIND_IMAGE) {
+    // Il payload è il file immagine già codificato: lo mostriamo tramite un URL blob
+    const blob = new Blob([new Uint8Array(buffer, HEADER_SIZE, count)], { type: IMAGE_MIME[variant] });
+    return { type: IMAGE_TYPES[flags], sensor, frame, url: URL.createObjectURL(blob) };
+  }
+  return { type: 'unknown', kind };
+}
+
+// Converte il vecchio formato JSON ([{x, y, z}, ...]) in un Float32Array
+function pointsFromJson(data) {
+  const positions = new Float32Array(data.length * 3);
+  data.forEach((p, i) => {
+    positions[i * 3] = p.x;
+    positions[i * 3 + 1] = p.y;
+    positions[i * 3 + 2] = p.z;
+  });
+  return positions;
+}
+
+// Aggiorna lo stato di un solo sensore, lasciando invariati gli altri
+const updateSensor = (setter, sensor, update) =>
+  setter((prev) => ({ ...prev, [sensor]: { ...prev[sensor], ...update } }));
+
+// subscription (facoltativa): { topics, max_rate, image_scale, point_budget }, vedi server/topics.py.
+// Senza, il server invia tutti i topic ad ogni frame
+export function useWebSocketData(url, subscription = null) {
+  // Nuvole per sensore (indice nel messaggio): { points, staticPoints, reflectivity, instanceId }
+  // points è un Float32Array x0, y0, z0, x1, ..., staticPoints l'ultimo keyframe dello sfondo statico
+  const [cloudsBySensor, setCloudsBySensor] = useState({});
+  const [detectionsBySensor, setDetectionsBySensor] = useState({});
   const [image1, setImage1] = useState(null);
   const [image2, setImage2] = useState(null);
   const [frame, setFrame] = useState(0);
+  const [stats, setStats] = useState(null); // metriche del server, se inviate (--stats-interval)
   const [socket, setSocket] = useState(null);
 
   useEffect(() => {
     const ws = new WebSocket(url);
+    ws.binaryType = 'arraybuffer';
     setSocket(ws); // Salva il websocket
 
+    // Chiede subito il keyframe dello sfondo statico (ignorato se il server non usa il modello di sfondo)
+    ws.onopen = () => {
+      if (subscription) {
+        ws.send(JSON.stringify({ type: 'subscribe', ...subscription }));
+      }
+      ws.send(JSON.stringify({ type: 'request_keyframe' }));
+    };
+
+    const urls = { image1: null, image2: null };
+    // Rilascia l'URL blob dell'immagine precedente quando ne arriva una nuova
+    const updateImage = (type, setter, url) => {
+      if (urls[type]?.startsWith('blob:')) {
+        URL.revokeObjectURL(urls[type]);
+      }
+      urls[type] = url;
+      setter(url);
+    };
+
     ws.onmessage = (event) => {
-      const message = JSON.parse(event.data);
+      const message = event.data instanceof ArrayBuffer
+        ? decodeBinaryMessage(event.data)
+        : JSON.parse(event.data);
 
+      // Con più sensori le immagini e il contatore dei frame sono quelli del sensore 0
+      const sensor = message.sensor ?? 0;
       switch (message.type) {
-        case 'point':
-          setPoints(message.data);
+        case 'point': {
+          const layer = message.layer ?? LAYER_FULL;
+          const positions = message.positions ?? pointsFromJson(message.data);
+          if (layer === LAYER_STATIC) {
+            updateSensor(setCloudsBySensor, sensor, { staticPoints: positions });
+            break;
+          }
+          updateSensor(setCloudsBySensor, sensor, {
+            points: positions,
+            reflectivity: message.reflectivity ?? null,
+            instanceId: message.instanceId ?? null,
+            // La nuvola completa sostituisce il keyframe
+            ...(layer === LAYER_FULL ? { staticPoints: null } : {}),
+          });
           break;
-        case 'detections': 
-          setDetections(message.data);
+        }
+        case 'detections':
+          setDetectionsBySensor((prev) => ({ ...prev, [sensor]: message.data }));
           break;
         case 'image1':
-          setImage1(message.data);
+          if (sensor === 0) {
+            updateImage('image1', setImage1, message.url ?? `data:image/png;base64,${message.data}`);
+          }
           break;
         case 'image2':
-          setImage2(message.data);
+          if (sensor === 0) {
+            updateImage('image2', setImage2, message.url ?? `data:image/png;base64,${message.data}`);
+          }
           break;
         case 'frame':
-          setFrame(message.frame);
+          if (sensor === 0) {
+            setFrame(message.frame);
+          }
+          break;
+        case 'stats':
+          setStats(message.data);
+          break;
+        case 'subscribed':
+          break; // Il server conferma la sottoscrizione con i valori effettivi
+        case 'error':
+          console.warn('Errore dal server:', message.message);
           break;
         default:
           console.warn('Messaggio sconosciuto ricevuto dal server:', message);
@@ -38,8 +152,21 @@ export function useWebSocketData(url) {
 
     return () => {
       ws.close();
+      Object.values(urls).forEach((u) => u?.startsWith('blob:') && URL.revokeObjectURL(u));
     };
-  }, [url]);
+    // La sottoscrizione è confrontata per valore, un nuovo oggetto a ogni render non riapre la connessione
+  }, [url, JSON.stringify(subscription)]); // eslint-disable-line react-hooks/exhaustive-deps
+
+  // Una nuvola per sensore e le detection di tutti i sensori, già nel sistema di riferimento comune della stazione
+  const clouds = useMemo(
+    () => Object.entries(cloudsBySensor).map(([sensor, cloud]) => ({ sensor: Number(sensor), ...cloud })),
+    [cloudsBySensor]
+  );
+  const detections = useMemo(
+    () => Object.entries(detectionsBySensor).flatMap(([sensor, data]) =>
+      data.map((detection) => ({ ...detection, sensor: Number(sensor) }))),
+    [detectionsBySensor]
+  );
 
-  return { points, detections, image1, image2, frame, socket }; // <-- aggiungi detections qui
+  return { clouds, detections, image1, image2, frame, stats, socket };
 }